@@ -0,0 +1,381 @@
+#============================================================================#
+# BENCHMARKS
+#============================================================================#
+
+'''
+Timing comparisons between the current feature pipeline and the code it
+replaced. Run a single benchmark by name, for example:
+
+    python benchmarks.py accumulator -sizes 100 1000 10000
+    python benchmarks.py gabor -sizes 256 512 1024
+    python benchmarks.py acwe -img_dir raw_train/ -scale 4 -refine 1
+    python benchmarks.py memory -img_dir raw_train/ -limit 20
+    python benchmarks.py hough -img_dir raw_train/ -angles 100
+    python benchmarks.py snake -img_dir raw_train/ -limit 20
+'''
+
+import os
+import argparse
+import timeit
+import tracemalloc
+import numpy as np
+import pandas as pd
+import pydicom
+from scipy import ndimage
+from skimage.filters import gabor_kernel, gaussian
+from skimage.transform import hough_line, hough_line_peaks
+from skimage.segmentation import active_contour
+
+import pipeline as pipe
+import preprocess as p
+import create_features as cf
+import features_ROI as adf
+from pixel_store import ImageView
+from intensity_stats import clear_histogram
+
+
+def fake_row(rng, i):
+    '''
+    Random feature row matching the pipeline schema
+    '''
+    row = {column: rng.random() for column in pipe.FEATURE_COLUMNS}
+    row['id'] = 'P_{:05d}'.format(i)
+
+    return row
+
+
+def bench_accumulator(args):
+    '''
+    Per-row cost of building the feature table with DataFrame.append versus
+    FeatureAccumulator, for increasing numbers of rows.
+    '''
+    rng = np.random.RandomState(0)
+    print('{:>8} {:>14} {:>14}'.format('rows', 'append us/row',
+                                       'accum us/row'))
+    for n_rows in args.sizes or [100, 1000, 10000]:
+        rows = [fake_row(rng, i) for i in range(n_rows)]
+
+        t0 = timeit.default_timer()
+        df = pd.DataFrame()
+        for row in rows:
+            df = df.append(row, ignore_index=True)
+        t_append = timeit.default_timer() - t0
+
+        t0 = timeit.default_timer()
+        features = pipe.FeatureAccumulator(pipe.FEATURE_COLUMNS, n_rows)
+        for row in rows:
+            features.add(row)
+        features.to_frame()
+        t_accum = timeit.default_timer() - t0
+
+        print('{:>8} {:>14.1f} {:>14.1f}'.format(n_rows,
+                                                 1e6 * t_append / n_rows,
+                                                 1e6 * t_accum / n_rows))
+
+
+def legacy_gabor(orig):
+    '''
+    generate_gabor as it was before the FFT kernel bank: kernels rebuilt on
+    every call and one spatial convolution per kernel
+    '''
+    kernels = []
+    for theta in range(4):
+        theta = theta / 4. * np.pi
+        for sigma in (1, 3):
+            for frequency in (0.05, 0.25):
+                kernel = np.real(gabor_kernel(frequency, theta=theta,
+                                              sigma_x=sigma, sigma_y=sigma))
+                kernels.append(kernel)
+
+    feats = np.zeros((len(kernels), 2), dtype=np.double)
+    for k, kernel in enumerate(kernels):
+        filtered = ndimage.convolve(orig, kernel, mode='wrap')
+        feats[k, 0] = filtered.mean()
+        feats[k, 1] = filtered.var()
+    return feats
+
+
+def bench_gabor(args):
+    '''
+    Time per image of the legacy spatial Gabor filtering versus the FFT
+    kernel bank, on random square uint16 images of increasing side length.
+    Also reports the largest relative difference from spatial filtering of
+    the same image as float.
+    '''
+    rng = np.random.RandomState(0)
+    print('{:>6} {:>12} {:>12} {:>9} {:>10}'.format('side', 'legacy s',
+                                                    'fft s', 'speedup',
+                                                    'max rel'))
+    for side in args.sizes or [256, 512, 1024]:
+        img = rng.randint(0, 2 ** 16, (side, side)).astype(np.uint16)
+
+        t0 = timeit.default_timer()
+        legacy_gabor(img)
+        t_legacy = timeit.default_timer() - t0
+
+        t0 = timeit.default_timer()
+        feats = adf.gabor_features(img)
+        t_fft = timeit.default_timer() - t0
+
+        reference = legacy_gabor(img.astype(np.float64))
+        error = np.max(np.abs(feats - reference) / np.abs(reference))
+
+        print('{:>6} {:>12.3f} {:>12.3f} {:>8.1f}x {:>10.1e}'.format(
+              side, t_legacy, t_fft, t_legacy / t_fft, error))
+
+
+def dice(a, b):
+    '''
+    Dice coefficient between two masks
+    '''
+    a = np.asarray(a, dtype=bool)
+    b = np.asarray(b, dtype=bool)
+    total = a.sum() + b.sum()
+    return 2.0 * np.logical_and(a, b).sum() / total if total else 1.0
+
+
+def read_corpus(args):
+    '''
+    Yields (file, pixel array) for the images of args.img_dir
+    '''
+    for file in sorted(os.listdir(args.img_dir))[:args.limit]:
+        try:
+            yield file, pydicom.dcmread(args.img_dir + file,
+                                        force=True).pixel_array
+        except Exception as e:
+            print('Could not read: ', file)
+            print(e)
+
+
+def bench_acwe(args):
+    '''
+    Mask agreement (Dice) and wall time of coarse-to-fine ACWE versus the
+    single-scale segmentation, over the images of a directory.
+    '''
+    pyramid = dict(p.SEGMENTATION_PARAMS, acwe_scale=args.scale,
+                   acwe_refine_iterations=args.refine)
+    single = dict(p.SEGMENTATION_PARAMS, acwe_scale=1)
+
+    scores, t_single, t_pyramid = [], 0, 0
+    print('{:<60} {:>8} {:>10} {:>10}'.format('file', 'dice', 'single s',
+                                              'pyramid s'))
+    for file, pixels in read_corpus(args):
+        t0 = timeit.default_timer()
+        reference = p.segment_pixels(pixels, single)
+        t1 = timeit.default_timer()
+        mask = p.segment_pixels(pixels, pyramid)
+        t2 = timeit.default_timer()
+
+        scores.append(dice(reference, mask))
+        t_single += t1 - t0
+        t_pyramid += t2 - t1
+        print('{:<60} {:>8.4f} {:>10.3f} {:>10.3f}'.format(
+              file[:60], scores[-1], t1 - t0, t2 - t1))
+
+    if scores:
+        print('images: {}  mean dice: {:.4f}  min dice: {:.4f}'.format(
+              len(scores), np.mean(scores), np.min(scores)))
+        print('single-scale: {:.1f}s  pyramid (scale {}, refine {}): {:.1f}s'
+              '  speedup: {:.1f}x'.format(t_single, args.scale, args.refine,
+                                          t_pyramid, t_single / t_pyramid))
+
+
+def traced_peak(func, *args):
+    '''
+    Runs a function under tracemalloc (numpy reports its buffers to it)
+    Returns: result and peak traced memory in bytes
+    '''
+    tracemalloc.start()
+    try:
+        result = func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return result, peak
+
+
+def featurize_pixels(pixels, params):
+    '''
+    Segmentation and manual features of one pixel array
+    '''
+    mask = p.segment_pixels(pixels, params)
+    return mask, cf.make_all_features(ImageView(pixels, ''), mask)
+
+
+def bench_memory(args):
+    '''
+    Peak traced memory of segmentation plus feature generation in lean mode
+    (boolean masks, float32 binary image) versus the float64 path, per image.
+    Also reports mask agreement (Dice) and the largest relative difference
+    over the manual features.
+    '''
+    full = dict(p.SEGMENTATION_PARAMS, lean=False)
+    lean = dict(p.SEGMENTATION_PARAMS, lean=True)
+
+    print('{:<60} {:>9} {:>9} {:>10} {:>8} {:>9}'.format(
+          'file', 'raw MB', 'full MB', 'lean MB', 'dice', 'max rel'))
+    reductions = []
+    for file, pixels in read_corpus(args):
+        # each run builds its own histogram, so neither is measured with
+        # the other's cached one
+        clear_histogram()
+        (mask, feats), peak_full = traced_peak(featurize_pixels, pixels, full)
+        clear_histogram()
+        (lean_mask, lean_feats), peak_lean = traced_peak(featurize_pixels,
+                                                          pixels, lean)
+
+        error = max(abs(lean_feats[f] - feats[f]) / max(abs(feats[f]), 1e-12)
+                    for f in feats)
+        reductions.append(1 - peak_lean / peak_full)
+        print('{:<60} {:>9.1f} {:>9.1f} {:>10.1f} {:>8.4f} {:>9.1e}'.format(
+              file[:60], pixels.nbytes / 1e6, peak_full / 1e6,
+              peak_lean / 1e6, dice(mask, lean_mask), error))
+
+    if reductions:
+        print('images: {}  mean peak reduction: {:.0%}  min: {:.0%}'.format(
+              len(reductions), np.mean(reductions), np.min(reductions)))
+
+
+def legacy_hough(original):
+    '''
+    generate_hough as it was before the edges were restricted to the mass
+    border: every edge pixel of the crop votes through hough_line and the
+    lines are counted in a Python loop
+    '''
+    orig = original.pixel_array
+    lines = []
+    edges = cf.helper_edges(original)
+    tested_angles = np.linspace(-np.pi / 2, np.pi / 2, 100)
+    h, theta, d = hough_line(edges, theta=tested_angles)
+
+    origin = np.array((0, orig.shape[1]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for _, angle, dist in zip(*hough_line_peaks(h, theta, d)):
+            y0, y1 = (dist - origin * np.cos(angle)) / np.sin(angle)
+            lines.append(abs(y0 - y1))
+    return len(lines)
+
+
+def bench_hough(args):
+    '''
+    Throughput of the legacy Hough line count versus hough_line on the edges
+    within a band around the mask border, as create_features.generate_hough
+    runs it on the ROI crops. Edge detection is timed on both sides,
+    segmentation is not. Also checks that without the band
+    create_features.generate_hough finds the same number of lines as the
+    legacy code.
+    '''
+    print('{:<60} {:>8} {:>8} {:>8} {:>10} {:>10}'.format(
+          'file', 'edges', 'in band', 'lines', 'legacy s', 'band s'))
+    t_legacy, t_band, n_images, mismatches = 0, 0, 0, 0
+    for file, pixels in read_corpus(args):
+        mask = p.segment_pixels(pixels)
+        window = cf.roi_window(mask, cf.ROI_MARGIN)
+        roi = ImageView(pixels[window], '')
+        roi_mask = mask[window]
+
+        t0 = timeit.default_timer()
+        legacy = legacy_hough(roi)
+        t1 = timeit.default_timer()
+        edges = cf.helper_edges(roi)
+        band = cf.border_band(roi_mask, args.band)
+        lines = cf.generate_hough(roi, edges, band, args.angles)
+        t2 = timeit.default_timer()
+
+        mismatches += cf.generate_hough(roi, edges, n_angles=100) != legacy
+        t_legacy += t1 - t0
+        t_band += t2 - t1
+        n_images += 1
+        print('{:<60} {:>8} {:>8} {:>8} {:>10.3f} {:>10.3f}'.format(
+              file[:60], np.count_nonzero(edges),
+              np.count_nonzero(edges & band), lines, t1 - t0, t2 - t1))
+
+    if n_images:
+        print('images: {}  legacy: {:.1f} img/s  band ({} px, {} angles): '
+              '{:.1f} img/s  unbanded count mismatches: {}'.format(
+              n_images, n_images / t_legacy, args.band, args.angles,
+              n_images / t_band, mismatches))
+
+
+def legacy_roi_snake(smoothed):
+    '''
+    features_ROI.generate_snake as it was before the mask-seeded snake: one
+    point per 100 pixels of the image on a fixed circle at (200, 220), up to
+    2500 iterations
+    '''
+    s = np.linspace(0, 2*np.pi, round(0.01 * smoothed.size))
+    init = np.array([200 + 100*np.sin(s), 220 + 100*np.cos(s)]).T
+    snake = active_contour(smoothed, init, alpha=0.015, beta=10, gamma=0.001)
+    return int(np.mean(np.sqrt(np.sum((init - snake) ** 2, axis=1))))
+
+
+def bench_snake(args):
+    '''
+    Time per image of the snake feature as the pipeline ran it before (fixed
+    100 point circle at (200, 220), up to 2500 iterations) versus the
+    mask-seeded snake sized to the region perimeter, on the pipeline's ROI
+    crops. With -roi_snake, also times features_ROI's former sizing of one
+    point per 100 pixels, which is very slow on large crops. Segmentation
+    and smoothing are not timed.
+    '''
+    print('{:<60} {:>7} {:>8} {:>8} {:>10} {:>10} {:>10}'.format(
+          'file', 'points', 'legacy', 'seeded', 'legacy s', 'seeded s',
+          'roi 1% s'))
+    t_legacy, t_seeded, t_roi, n_images = 0, 0, 0, 0
+    for file, pixels in read_corpus(args):
+        mask = p.segment_pixels(pixels)
+        window = cf.roi_window(mask, cf.ROI_MARGIN)
+        roi = ImageView(pixels[window], '')
+        smoothed = gaussian(roi.pixel_array, 3)
+        init = adf.snake_seed(mask[window])
+
+        t0 = timeit.default_timer()
+        legacy = cf.generate_snake(roi, smoothed)
+        t1 = timeit.default_timer()
+        seeded = adf.fit_snake(smoothed, init)
+        t2 = timeit.default_timer()
+        if args.roi_snake:
+            legacy_roi_snake(smoothed)
+        t3 = timeit.default_timer()
+
+        t_legacy += t1 - t0
+        t_seeded += t2 - t1
+        t_roi += t3 - t2
+        n_images += 1
+        print('{:<60} {:>7} {:>8} {:>8} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+              file[:60], len(init), legacy, seeded, t1 - t0, t2 - t1, t3 - t2))
+
+    if n_images:
+        print('images: {}  legacy: {:.2f}s/img  seeded: {:.2f}s/img  '
+              'speedup: {:.1f}x'.format(n_images, t_legacy / n_images,
+                                        t_seeded / n_images,
+                                        t_legacy / t_seeded))
+        if args.roi_snake:
+            print('roi 1%: {:.2f}s/img  speedup: {:.1f}x'.format(
+                  t_roi / n_images, t_roi / t_seeded))
+
+
+BENCHMARKS = {'accumulator': bench_accumulator,
+              'gabor': bench_gabor,
+              'acwe': bench_acwe,
+              'memory': bench_memory,
+              'hough': bench_hough,
+              'snake': bench_snake}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS), help="Benchmark to run")
+    parser.add_argument("-sizes", "--sizes", type=int, nargs="+", help="Row counts (accumulator) or image side lengths (gabor)")
+    parser.add_argument("-img_dir", "--img_dir", default="", help="Image directory for corpus benchmarks")
+    parser.add_argument("-limit", "--limit", type=int, default=None, help="Maximum number of corpus images")
+    parser.add_argument("-scale", "--scale", type=int, default=4, help="ACWE pyramid downsampling factor")
+    parser.add_argument("-refine", "--refine", type=int, default=1, help="ACWE full-resolution refinement iterations")
+    parser.add_argument("-angles", "--angles", type=int, default=100, help="Hough transform angles")
+    parser.add_argument("-band", "--band", type=int, default=10, help="Hough border band width in pixels")
+    parser.add_argument("-roi_snake", "--roi_snake", action="store_true", help="Also time the former features_ROI snake sizing (slow)")
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](args)
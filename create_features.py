@@ -25,6 +25,7 @@ from skimage.filters import sobel_h
 from skimage.filters import sobel_v
 from skimage.filters import scharr_h
 from skimage.filters import scharr_v
+from skimage.filters.edges import _mask_filter_result
 from skimage.segmentation import clear_border
 from skimage.measure import label, regionprops
 from skimage.morphology import closing, square, disk, opening
@@ -47,6 +48,10 @@ from skimage.transform import hough_line, hough_line_peaks
 
 import preprocess as p
 import features_ROI as adf
+from intensity_stats import histogram_of
+from pixel_store import ImageView
+from region_geometry import RegionGeometry
+from feature_registry import FeatureScheduler
 
 pd.set_option('display.max_columns', 500)
 @ignore_warnings(category=FutureWarning)
@@ -70,26 +75,14 @@ def apply_contour(img):
     ax.axis([0, a8.shape[1], a8.shape[0], 0])
     plt.show()
 
-def store_evolution_in(lst):
-    """Returns a callback function to store the evolution of the level sets in
-    the given list.
-    """
-
-    def _store(x):
-        lst.append(np.copy(x))
-
-    return _store
-
 def apply_ACWE(img):
     '''
     '''
     image = img_as_float(img)
     init_ls = checkerboard_level_set(image.shape, 6)
-    # List with intermediate results for plotting the evolution
-    evolution = []
-    callback = store_evolution_in(evolution)
-    ls = morphological_chan_vese(image, 35, init_level_set=init_ls, smoothing=3,
-                                 iter_callback=callback)
+    # debug run keeps the intermediate results for plotting the evolution
+    ls, used, evolution = p.run_ACWE(image, 35, init_ls, smoothing=3,
+                                     debug=True)
     
     fig, axes = plt.subplots(2, 2, figsize=(8, 8))
     ax = axes.flatten()
@@ -100,7 +93,7 @@ def apply_ACWE(img):
     contour = ax[1].contour(evolution[7], [0.5], colors='y')
     contour.collections[0].set_label("Iteration 7")
     contour = ax[1].contour(evolution[-1], [0.5], colors='r')
-    contour.collections[0].set_label("Iteration 35")
+    contour.collections[0].set_label("Iteration {}".format(used))
     ax[1].legend(loc="upper right")
     title = "Morphological ACWE evolution"
     ax[1].set_title(title, fontsize=12)
@@ -137,6 +130,33 @@ def compute_scharr(img, mask = None):
     return np.arctan2(s_v, s_h), np.sqrt(s_v**2 + s_h**2)
 
 
+def compute_scharr_field(img):
+    '''
+    Compute the unmasked Scharr gradient components once, so that several
+    masks can be applied to them afterwards with select_gradient
+    Takes: image pixel array
+    Returns: horizontal and vertical gradient arrays
+    '''
+
+    return scharr_h(img), scharr_v(img)
+
+
+def select_gradient(field, mask = None):
+    '''
+    Restrict a precomputed Scharr field to a mask. Uses skimage's own masking
+    step, so the result is identical to compute_scharr(img, mask)
+    Takes: (horizontal, vertical) gradients from compute_scharr_field,
+           optional mask
+    Returns: array of angles and array of magnitudes
+    '''
+
+    s_h, s_v = field
+    if mask is not None:
+        s_h = _mask_filter_result(s_h.copy(), mask)
+        s_v = _mask_filter_result(s_v.copy(), mask)
+    return np.arctan2(s_v, s_h), np.sqrt(s_v**2 + s_h**2)
+
+
 def compute_gradient_std(theta, magnitude):
     '''
     Takes: array of angles and array of magnitudes from Sobel/Scharr
@@ -172,31 +192,58 @@ def get_border_pixels(mask):
     return distance
 
 
+def border_band(mask, width):
+    '''
+    Pixels within width (chessboard distance) of the region border, inside
+    or outside the region
+    Takes: segmented mask and band width in pixels
+    Returns: boolean band mask
+    '''
+    mask = np.asarray(mask, dtype=bool).view(np.uint8)
+    outer = ndimage.maximum_filter(mask, size=2 * width + 1)
+    inner = ndimage.minimum_filter(mask, size=2 * width + 1)
+    return (outer > inner)
+
+
+def spiculation_masks(segmented_mask):
+    '''
+    Neighborhood masks used by compute_spiculation. They only depend on the
+    segmentation, so the raw and rescaled spiculation groups can share them
+    Takes: segmented mask
+    Returns: 3 pixel border mask and opened non-region mask
+    '''
+    border_mask = get_border_pixels(segmented_mask)
+    open_nonregion = opening(np.where(segmented_mask == 0, 1, 0), disk(5))
+    return border_mask, open_nonregion
+
+
 # TO DO: try more of the neighborhoods in Huo and Giger (1995)
-def compute_spiculation(orig, segmented_mask):
+def compute_spiculation(orig, segmented_mask, field = None, masks = None):
     
     # filter approach based on Huo and Giger (1995)
     # they use Sobel but Scharr is supposed to be rotation invariant (?)
-    theta_A, magnitude_A = compute_scharr(orig, mask = segmented_mask)
+    # the gradient is computed once and each neighborhood below masks it
+    # (callers may pass a precomputed field and spiculation_masks)
+    if field is None:
+        field = compute_scharr_field(orig)
+    if masks is None:
+        masks = spiculation_masks(segmented_mask)
+    border_mask, open_nonregion = masks
+    theta_A, magnitude_A = select_gradient(field, mask = segmented_mask)
     std_dev_A = compute_gradient_std(theta_A, magnitude_A)
 
     # B: just use a 3? pixel border
-    border_mask = get_border_pixels(segmented_mask)
-    theta_B, magnitude_B = compute_scharr(orig, mask = border_mask)
+    theta_B, magnitude_B = select_gradient(field, mask = border_mask)
     std_dev_B = compute_gradient_std(theta_B, magnitude_B)
 
     # C: use the whole ROI 
-    # ideally would reduce to 20 pixel adjacent area but not working right now
-    # ymin, xmin, ymax, xmax = regionprops(segmented_mask[0]).bbox
-    # bbox_mask = np.zeros(orig.shape)
-    # bbox_mask[ymin:ymax, xmin:xmax] = 1
-    # region_bbox = orig * bbox_mask
-    theta_C, magnitude_C = compute_scharr(orig)
+    # make_all_features passes the region's bounding box plus ROI_MARGIN,
+    # so this is the area adjacent to the region rather than the full image
+    theta_C, magnitude_C = select_gradient(field)
     std_dev_C = compute_gradient_std(theta_C, magnitude_C)
 
     # D: use non-region ROI after applying opening (circular, arbitrary size right now)
-    open_nonregion = opening(np.where(segmented_mask == 0, 1, 0), disk(5))
-    theta_D, magnitude_D = compute_scharr(orig, mask = open_nonregion)
+    theta_D, magnitude_D = select_gradient(field, mask = open_nonregion)
     std_dev_D = compute_gradient_std(theta_D, magnitude_D)
 
     # higher standard deviation here indicates more spiculation
@@ -225,32 +272,27 @@ def circular_mask(matrix, center, radius):
     y, x = np.ogrid[:h, :w]
     dist_from_center = np.sqrt((x - center[0]) ** 2 + (y - center[1]) ** 2)
     mask = dist_from_center <= radius
-    empty_image = np.zeros((matrix.shape[0], matrix.shape[1]))
-    matrix_copy = matrix.copy()
+    # boolean masks (lean mode) cannot hold the outside marker 2
+    if matrix.dtype == bool:
+        matrix_copy = matrix.astype(np.uint8)
+    else:
+        matrix_copy = matrix.copy()
     matrix_copy[~mask] = 2
 
     return matrix_copy
 
 
-def compute_circularity(filled):
+def compute_circularity(filled, geometry=None):
     '''
-    Computes circularity given an image with one region.
+    Computes circularity given an image with one region: the share of the
+    circle with the region's area, centered on its center of mass, that the
+    region covers (see circular_mask to visualize the circle).
+    Takes: region mask and optionally its RegionGeometry, to reuse its labels
     '''
-    label_image = label(filled)
-    regions = regionprops(label_image)
-    # Find center of mass
-    y0, x0 = regions[0].centroid
-    # Find area of segment
-    area = regions[0].area
-    # Create circle with this area
-    radius = np.sqrt(area / np.pi)
-    masked_image = circular_mask(filled, [x0, y0], radius) # Visualize this
-    # Calculate circularity
-    overlap = np.count_nonzero(masked_image == 1)
-    rest_of_circle = np.count_nonzero(masked_image == 0)
-    circularity = overlap / (overlap + rest_of_circle)
+    if geometry is None:
+        geometry = RegionGeometry(filled)
 
-    return circularity
+    return geometry.circularity()
 
 
 ###### PARTH FEATURES #########
@@ -284,6 +326,35 @@ def helper_bbox(img):
     bbox = np.min(a[0]), np.max(a[0]), np.min(a[1]), np.max(a[1])
     return bbox
 
+def roi_window(mask, margin):
+    '''
+    Bounding box of the segmented region grown by a margin and clipped to the
+    image, so that features can work on the lesion instead of the whole image
+    Takes: region mask pixel array and margin in pixels (None for the whole
+           image)
+    Returns: tuple of row and column slices
+    '''
+    if margin is None:
+        return (slice(None), slice(None))
+
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if rows.size == 0:
+        return (slice(None), slice(None))
+
+    return (slice(max(rows[0] - margin, 0), rows[-1] + margin + 1),
+            slice(max(cols[0] - margin, 0), cols[-1] + margin + 1))
+
+
+def crop_image(original, window):
+    '''
+    Zero-copy crop of an image that can be passed to the generate_* functions
+    Takes: original image (dicom) and window from roi_window
+    Returns: ImageView of the cropped pixels
+    '''
+    return ImageView(original.pixel_array[window], original.PatientID)
+
+
 def generate_iou(original, segmented_mask):
     '''
     Get intersection area using bounding box defined on area
@@ -323,42 +394,47 @@ def helper_edges(original):
     Returns edges
     '''
     orig = original.pixel_array
+    hist = histogram_of(orig)
 
-    thresh = threshold_mean(orig) # binarise image
+    # binarise image
+    thresh = threshold_mean(orig) if hist is None else hist.mean()
     binary = orig > thresh
     edges = canny(binary, sigma=5)
 
     return edges
 
-def generate_hough(original):
+def generate_hough(original, edges=None, band=None,
+                   n_angles=adf.HOUGH_ANGLES):
     '''
     Active contour model
         Define segmented mask proportional to the target mass region 
+    Takes: image, optionally its helper_edges, optionally a border_band of
+           the region to keep only the edges near the mass border, and the
+           number of angles tested
     Returns number of lines
     ''' 
-    orig = original.pixel_array
-    lines = []
-    edges = helper_edges(original)  # get edges from canny
-    tested_angles = np.linspace(-np.pi / 2, np.pi / 2, 100) # permute over angles
-    h, theta, d = hough_line(edges, theta=tested_angles)
-
+    if edges is None:
+        edges = helper_edges(original)  # get edges from canny
+    if band is not None:
+        edges = edges & band
+    return adf.count_hough_lines(edges, n_angles)
 
-    origin = np.array((0, orig.shape[1]))
-    for _, angle, dist in zip(*hough_line_peaks(h, theta, d)):
-        y0, y1 = (dist - origin * np.cos(angle)) / np.sin(angle)
-        inter_lines = abs(y0-y1) 
-        lines.append(inter_lines)
-    num_lines = len(lines)
-    return num_lines
 
-
-def generate_snake(original):
+def generate_snake(original, smoothed=None, mask=None):
     '''
     Active contour model
         Define segmented mask proportional to the target mass region 
+    Takes: image, optionally gaussian(orig, 3), and optionally the region
+           mask; with a mask the snake is seeded from the region and sized
+           to its perimeter (see features_ROI.SNAKE_PARAMS), otherwise it
+           starts from a fixed circle at (200, 220)
     returns rugged mean dist from defined centroid at r,c
     ''' 
     orig = original.pixel_array
+    if smoothed is None:
+        smoothed = gaussian(orig, 3)
+    if mask is not None:
+        return adf.fit_snake(smoothed, adf.snake_seed(mask))
 
     # spic_area = round(0.01*orig.size)
     spic_area = 100
@@ -367,7 +443,7 @@ def generate_snake(original):
     r = 200 + 100*np.sin(s)
     c = 220 + 100*np.cos(s)
     init = np.array([r, c]).T
-    snake = active_contour(gaussian(orig, 3),
+    snake = active_contour(smoothed,
                              init, alpha=0.015, beta=10, gamma=0.001)
 
     snake_array = np.asarray(snake)
@@ -378,63 +454,143 @@ def generate_snake(original):
 
 def generate_gabor(original):
     '''
-    Gabor features
-    '''    
-    orig = original.pixel_array
-    kernels = []
-    for theta in range(4):
-        theta = theta / 4. * np.pi
-        for sigma in (1, 3):
-            for frequency in (0.05, 0.25):
-                kernel = np.real(gabor_kernel(frequency, theta=theta,
-                                              sigma_x=sigma, sigma_y=sigma))
-                kernels.append(kernel)
+    Gabor features, see features_ROI.generate_gabor
+    '''
+    return adf.generate_gabor(original)
+
+
+
+# Version tag for each feature group; bump a group's tag whenever its code
+# changes so that cached values (see feature_cache.py) are recomputed
+FEATURE_VERSIONS = {'spiculation': 2,
+                    'spiculation_rescaled': 2,
+                    'circularity': 1,
+                    'iou': 1,
+                    'hough': 3,
+                    'snake': 3,
+                    'gabor': 3}
+
+# Columns produced by each feature group
+FEATURE_COLUMNS = {'spiculation': ['spiculationA', 'spiculationB',
+                                   'spiculationC', 'spiculationD'],
+                   'spiculation_rescaled': ['spiculationRA', 'spiculationRB',
+                                            'spiculationRC', 'spiculationRD'],
+                   'circularity': ['circularity'],
+                   'iou': ['iou'],
+                   'hough': ['hough'],
+                   'snake': ['snake'],
+                   'gabor': adf.gabor_columns()}
+
 
-    feats = np.zeros((len(kernels), 2), dtype=np.double)
-    for k, kernel in enumerate(kernels):
-        filtered = ndimage.convolve(orig, kernel, mode='wrap')
-        feats[k, 0] = filtered.mean()
-        feats[k, 1] = filtered.var()
-    return len(feats)
+# Margin (pixels) kept around the segmented region's bounding box when
+# cropping the image for feature generation; bump the versions of the
+# cropped groups above when changing it
+ROI_MARGIN = 20
 
+# Width (pixels) of the band around the region border whose edges vote in
+# the Hough transform; bump the hough version when changing it
+HOUGH_BAND = 10
 
 
-def make_all_features(original, filled):
+def spiculation_features(roi, roi_mask, field, masks):
     '''
-    Runs all manual feature generation features on image
-    Takes: original image (dicom) and region mask pixel array
-    Returns: single row of data frame with features computed
+    Spiculation feature group on the cropped image
+    '''
+    spiculation = compute_spiculation(roi.pixel_array, roi_mask, field, masks)
+    return {'spiculationA': spiculation['A'], \
+            'spiculationB': spiculation['B'], \
+            'spiculationC': spiculation['C'], \
+            'spiculationD': spiculation['D']}
+
+
+def rescaled_spiculation_features(roi, roi_mask, intensity_range, masks):
+    '''
+    Spiculation computed on a rescaled version of the image (intensity range
+    taken from the whole image, applied to the crop)
+    '''
+    img_scaled = exposure.rescale_intensity(roi.pixel_array,
+                                            in_range=intensity_range)
+    spiculation_rescaled = compute_spiculation(img_scaled, roi_mask,
+                                               masks=masks)
+    return {'spiculationRA': spiculation_rescaled['B'], \
+            'spiculationRB': spiculation_rescaled['B'], \
+            'spiculationRC': spiculation_rescaled['C'], \
+            'spiculationRD': spiculation_rescaled['D']}
+
+
+def intensity_range(original):
+    '''
+    Returns: 50th and 100th intensity percentiles of the whole image
     '''
-    
     orig = original.pixel_array
-    spiculation = compute_spiculation(orig, filled)
-
-    # try computing spiculation on a rescaled version of the image
-    p_thresh, p100 = np.percentile(orig, (50, 100))
-    img_scaled = exposure.rescale_intensity(orig, in_range=(p_thresh, p100))
-    spiculation_rescaled = compute_spiculation(img_scaled, filled)
-    circularity = compute_circularity(filled)
-    # Parth's features
-    iou = generate_iou(original, filled)
-    hough = generate_hough(original)
-    snake = generate_snake(original)
-    gabor = generate_gabor(original)
-
-    mf = {'spiculationA': spiculation['A'], \
-         'spiculationB': spiculation['B'], \
-         'spiculationC': spiculation['C'], \
-         'spiculationD': spiculation['D'], \
-         'spiculationRA': spiculation_rescaled['B'], \
-         'spiculationRB': spiculation_rescaled['B'], \
-         'spiculationRC': spiculation_rescaled['C'], \
-         'spiculationRD': spiculation_rescaled['D'],
-         'circularity': circularity, \
-         'iou': iou, \
-         'hough': hough, \
-         'snake': snake, \
-         'gabor': gabor}
-    
-    return mf
+    hist = histogram_of(orig)
+    if hist is None:
+        return tuple(np.percentile(orig, (50, 100)))
+    return tuple(hist.percentile((50, 100)))
+
+
+# Intermediates shared between feature groups, as name -> (function, inputs).
+# Inputs not listed here are passed in by make_all_features.
+INTERMEDIATES = {'window': (roi_window, ['filled', 'margin']),
+                 'roi': (crop_image, ['original', 'window']),
+                 'roi_mask': (lambda filled, window: filled[window],
+                              ['filled', 'window']),
+                 'roi_field': (lambda roi: compute_scharr_field(roi.pixel_array),
+                               ['roi']),
+                 'spiculation_masks': (spiculation_masks, ['roi_mask']),
+                 'intensity_range': (intensity_range, ['original']),
+                 'geometry': (RegionGeometry, ['filled']),
+                 'edges': (helper_edges, ['roi']),
+                 'hough_band': (lambda roi_mask: border_band(roi_mask,
+                                                             HOUGH_BAND),
+                                ['roi_mask']),
+                 'smoothed': (lambda roi: gaussian(roi.pixel_array, 3),
+                              ['roi'])}
+
+# Feature groups (keys of FEATURE_VERSIONS), as name -> (function, inputs);
+# each function returns the group's FEATURE_COLUMNS. Spiculation, Hough,
+# snake and Gabor see only the region's bounding box plus margin;
+# circularity and iou are defined on the whole image and mask.
+FEATURE_FUNCTIONS = {
+    'spiculation': (spiculation_features,
+                    ['roi', 'roi_mask', 'roi_field', 'spiculation_masks']),
+    'spiculation_rescaled': (rescaled_spiculation_features,
+                             ['roi', 'roi_mask', 'intensity_range',
+                              'spiculation_masks']),
+    'circularity': (lambda geometry: {'circularity': geometry.circularity()},
+                    ['geometry']),
+    'iou': (lambda original, filled: {'iou': generate_iou(original, filled)},
+            ['original', 'filled']),
+    'hough': (lambda roi, edges, band: {'hough': generate_hough(roi, edges,
+                                                                band)},
+              ['roi', 'edges', 'hough_band']),
+    'snake': (lambda roi, smoothed, roi_mask: {'snake': generate_snake(
+                  roi, smoothed, roi_mask)},
+              ['roi', 'smoothed', 'roi_mask']),
+    'gabor': (generate_gabor, ['roi'])}
+
+SCHEDULER = FeatureScheduler(INTERMEDIATES, FEATURE_FUNCTIONS)
+
+
+def make_all_features(original, filled, features=None, margin=ROI_MARGIN,
+                      geometry=None, progress=None):
+    '''
+    Runs the selected manual feature groups on an image, building each shared
+    intermediate once (see INTERMEDIATES and feature_registry.py).
+    Takes: original image (dicom), region mask pixel array, optionally a
+           list of feature groups (keys of FEATURE_VERSIONS) to compute, the
+           crop margin (None to use the whole image), the mask's
+           RegionGeometry if the caller already has one, and a function told
+           the name of each feature group as it starts
+    Returns: single row of data frame with features computed
+    '''
+    if features is None:
+        features = list(FEATURE_VERSIONS)
+
+    inputs = {'original': original, 'filled': filled, 'margin': margin,
+              'geometry': geometry}
+
+    return SCHEDULER.run(inputs, features, progress)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,162 @@
+#============================================================================#
+# ON-DISK FEATURE CACHE
+#============================================================================#
+
+'''
+Content-addressed cache for computed features. Each entry is keyed on a hash
+of the image's raw pixel data and the segmentation parameters its mask was
+made with, plus a feature group name and its version tag, so renaming or
+moving files keeps their entries, changing a segmentation parameter misses,
+and bumping a version in create_features.FEATURE_VERSIONS invalidates only
+that group. Entries are
+small JSON files; the least recently used ones are evicted once the cache
+grows past its size limit.
+'''
+
+import os
+import json
+import hashlib
+
+DEFAULT_MAX_BYTES = 1024 ** 3
+
+
+def pixel_digest(original):
+    '''
+    Hashes the raw (undecoded) pixel data of a DICOM image. An image read
+    from a PixelStore carries the digest of the file it was converted from.
+    Takes: pydicom dataset or ImageView
+    Returns: hex digest string
+    '''
+    digest = getattr(original, 'digest', None)
+    if digest:
+        return digest
+    return hashlib.sha1(original.PixelData).hexdigest()
+
+
+class FeatureCache:
+    '''
+    Persistent feature cache stored under cache_dir.
+
+    Input:
+        cache_dir (str): directory holding cache entries
+        max_bytes (int): size limit enforced by prune()
+    '''
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+
+    @staticmethod
+    def digest(original, params):
+        '''
+        Identifies an image together with the segmentation parameters its
+        features are computed under, as MaskStore.key does
+        Takes: pydicom dataset and dict of segmentation parameters
+        Returns: hex digest string
+        '''
+        params = json.dumps(params, sort_keys=True)
+        return hashlib.sha1('{}:{}'.format(pixel_digest(original),
+                                           params).encode()).hexdigest()
+
+
+    def _path(self, digest, feature, version):
+        '''
+        Location of the entry for one feature group of one image
+        '''
+        key = hashlib.sha1('{}:{}:{}'.format(digest, feature,
+                                             version).encode()).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+
+    def get(self, digest, feature, version):
+        '''
+        Looks up a cached feature group, marking it as recently used
+        Takes: digest from digest(), feature group name, and version tag
+        Returns: dict of feature values, or None on a miss
+        '''
+        path = self._path(digest, feature, version)
+        try:
+            with open(path) as f:
+                values = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        os.utime(path)
+        self.hits += 1
+        return values
+
+
+    def put(self, digest, feature, version, values):
+        '''
+        Stores one feature group for an image
+        Takes: digest from digest(), feature group name, version tag, and
+               dict of feature values
+        '''
+        path = self._path(digest, feature, version)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        values = {key: float(values[key]) for key in values}
+
+        # write then rename so concurrent workers never see partial entries
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(values, f)
+        os.replace(tmp_path, path)
+
+
+    def take_counts(self):
+        '''
+        Returns hit and miss counts since the last call and resets them.
+        Used to carry counts from worker processes back to the parent.
+        '''
+        counts = (self.hits, self.misses)
+        self.hits = 0
+        self.misses = 0
+        return counts
+
+
+    def add_counts(self, counts):
+        '''
+        Adds hit and miss counts gathered in a worker process
+        '''
+        self.hits += counts[0]
+        self.misses += counts[1]
+
+
+    def prune(self):
+        '''
+        Evicts least recently used entries until the cache fits in max_bytes
+        Returns: number of entries evicted
+        '''
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            evicted += 1
+
+        return evicted
+
+
+    def report(self):
+        '''
+        Prints hit and miss counters
+        '''
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0
+        print('Feature cache: {} hits, {} misses ({:.1%} hit rate)'.format(
+              self.hits, self.misses, rate))
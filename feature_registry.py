@@ -0,0 +1,99 @@
+#============================================================================#
+# FEATURE REGISTRY AND SCHEDULER
+#============================================================================#
+
+'''
+Feature groups and the intermediates they share (ROI crop, gradients, edge
+maps, smoothed images, ...) are declared as tables of
+
+    name -> (function, names of its inputs)
+
+see create_features.INTERMEDIATES and create_features.FEATURE_FUNCTIONS. For
+one image, FeatureScheduler runs only the selected groups, builds every
+intermediate they need exactly once and drops each intermediate as soon as
+its last consumer has run.
+'''
+
+from collections import Counter
+
+
+class FeatureScheduler:
+    '''
+    Dependency-aware runner for a feature registry.
+
+    Input:
+        intermediates (dict): name -> (function, list of input names)
+        features (dict): feature group -> (function, list of input names);
+                         each function returns a dict of feature columns
+    '''
+
+    def __init__(self, intermediates, features):
+        self.intermediates = intermediates
+        self.features = features
+
+
+    def requirements(self, selected, available=()):
+        '''
+        Intermediates needed to compute the selected groups
+        Takes: list of feature groups and names of values already available
+        Returns: set of intermediate names that have to be built
+        '''
+        needed = set()
+        pending = [dep for group in selected for dep in self.features[group][1]]
+        while pending:
+            name = pending.pop()
+            if name in needed or name in available \
+                or name not in self.intermediates:
+                continue
+            needed.add(name)
+            pending.extend(self.intermediates[name][1])
+
+        return needed
+
+
+    def run(self, inputs, selected, progress=None):
+        '''
+        Computes the selected feature groups for one image, in registry
+        order. Inputs set to None are built from the registry if it has them.
+        Takes: dict of input values (e.g. original, filled), list of feature
+               groups, and optionally a function called with each group's
+               name before it starts (intermediates it builds count toward it)
+        Returns: dict of feature columns
+        '''
+        unknown = set(selected) - set(self.features)
+        if unknown:
+            raise ValueError('Unknown features: ' + ', '.join(sorted(unknown)))
+
+        values = {name: value for name, value in inputs.items()
+                  if value is not None or name not in self.intermediates}
+        groups = [group for group in self.features if group in selected]
+
+        # number of consumers still to run for every value
+        uses = Counter()
+        for name in self.requirements(groups, values):
+            uses.update(self.intermediates[name][1])
+        for group in groups:
+            uses.update(self.features[group][1])
+
+        def release(deps):
+            for dep in deps:
+                uses[dep] -= 1
+                if uses[dep] == 0:
+                    del values[dep]
+
+        def build(name):
+            if name not in values:
+                function, deps = self.intermediates[name]
+                values[name] = function(*[build(dep) for dep in deps])
+                release(deps)
+            return values[name]
+
+        mf = {}
+        for group in groups:
+            function, deps = self.features[group]
+            if progress is not None:
+                progress(group)
+            mf.update(function(*[build(dep) for dep in deps]))
+            release(deps)
+
+        return mf
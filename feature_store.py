@@ -0,0 +1,174 @@
+#============================================================================#
+# INCREMENTAL FEATURE STORE
+#============================================================================#
+
+'''
+Feature table of already processed images plus a manifest of the files they
+came from (path, size, mtime, content hash). On a refresh only new or changed
+files are featurized, rows of files that disappeared are dropped, and the
+stored table is updated in place. Files whose size or mtime changed are
+re-hashed, so touching or copying a file without changing it does not
+trigger a recompute.
+
+The table is tied to a signature of the feature code and parameters (see
+pipeline.store_signature); a different signature discards the stored rows.
+'''
+
+import os
+import hashlib
+import pandas as pd
+
+MANIFEST_FILE = 'processed.csv'
+TABLE_FILE = 'features.csv'
+SIGNATURE_FILE = 'signature.txt'
+PROCESSED_COLUMNS = ['path', 'size', 'mtime', 'hash']
+
+
+def file_digest(path, block_size=2 ** 20):
+    '''
+    Hashes the content of a file
+    Takes: file path
+    Returns: hex digest string
+    '''
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def in_directory(paths, img_dir):
+    '''
+    Returns: boolean series, True for the paths directly inside img_dir
+    '''
+    return paths.map(os.path.dirname) == os.path.dirname(img_dir + 'x')
+
+
+class FeatureStore:
+    '''
+    Processed-file manifest and feature rows stored under store_dir.
+
+    Input:
+        store_dir (str): directory holding the manifest and feature table
+        signature (str): identifies the feature code and parameters
+    '''
+
+    def __init__(self, store_dir, signature):
+        self.store_dir = store_dir
+        self.signature = signature
+        os.makedirs(store_dir, exist_ok=True)
+
+        self.processed = pd.DataFrame(columns=PROCESSED_COLUMNS)
+        self.table = None
+        if self._read(SIGNATURE_FILE) == signature:
+            self.processed = pd.read_csv(self._path(MANIFEST_FILE),
+                                         dtype={'hash': str},
+                                         float_precision='round_trip')
+            self.table = pd.read_csv(self._path(TABLE_FILE),
+                                     dtype={'id': str},
+                                     float_precision='round_trip')
+        self.processed = self.processed.set_index('path', drop=False)
+
+
+    def _path(self, name):
+        return os.path.join(self.store_dir, name)
+
+
+    def _read(self, name):
+        '''
+        Contents of a small text file in the store, None if it is missing
+        '''
+        try:
+            with open(self._path(name)) as f:
+                return f.read()
+        except OSError:
+            return None
+
+
+    def plan(self, full_paths):
+        '''
+        Selects the files that have to be featurized
+        Takes: list of image paths
+        Returns: list of the paths that are new or whose content changed
+        '''
+        todo = []
+        for path in full_paths:
+            if path not in self.processed.index:
+                todo.append(path)
+                continue
+
+            entry = self.processed.loc[path]
+            stat = os.stat(path)
+            if stat.st_size == entry['size'] and \
+                stat.st_mtime == entry['mtime']:
+                continue
+            if file_digest(path) != entry['hash']:
+                todo.append(path)
+            else:
+                # same content, only the file metadata changed
+                self.processed.loc[path, ['size', 'mtime']] = \
+                    [stat.st_size, stat.st_mtime]
+
+        return todo
+
+
+    def update(self, img_dir, full_paths, todo, rows):
+        '''
+        Merges freshly computed rows into the stored table and saves it. Rows
+        of files in img_dir that are no longer listed are dropped, as are the
+        old rows of files that were featurized again (a file that failed is
+        left out, and retried on the next refresh).
+        Takes: image directory, list of its current image paths, the paths
+               returned by plan(), and dataframe of the new rows with a
+               'path' column
+        Returns: feature rows of full_paths, in that order, without 'path'
+        '''
+        processed = self.processed
+        gone = in_directory(processed['path'], img_dir) & \
+            ~processed['path'].isin(set(full_paths))
+        processed = processed[~gone & ~processed['path'].isin(set(todo))]
+
+        entries = []
+        for path in rows['path']:
+            stat = os.stat(path)
+            entries.append({'path': path, 'size': stat.st_size,
+                            'mtime': stat.st_mtime, 'hash': file_digest(path)})
+        new_entries = pd.DataFrame(entries, columns=PROCESSED_COLUMNS)
+        self.processed = pd.concat([processed, new_entries])
+        self.processed = self.processed.set_index('path', drop=False)
+
+        table = rows if self.table is None else \
+            pd.concat([self.table[self.table['path'].isin(processed['path'])],
+                       rows], sort=False)
+        self.table = table[rows.columns]
+        self.save()
+
+        merged = self.table.set_index('path', drop=False)
+        merged = merged.loc[[path for path in full_paths if path in merged.index]]
+        return merged.drop(columns='path').reset_index(drop=True)
+
+
+    def save(self):
+        '''
+        Writes the manifest, table and signature; each file is replaced
+        atomically
+        '''
+        outputs = {MANIFEST_FILE: self.processed.reset_index(drop=True),
+                   TABLE_FILE: self.table}
+        for name, df in outputs.items():
+            tmp_path = '{}.{}.tmp'.format(self._path(name), os.getpid())
+            df.to_csv(tmp_path, index=False)
+            os.replace(tmp_path, self._path(name))
+
+        tmp_path = '{}.{}.tmp'.format(self._path(SIGNATURE_FILE), os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(self.signature)
+        os.replace(tmp_path, self._path(SIGNATURE_FILE))
+
+
+    def report(self, n_files, n_todo):
+        '''
+        Prints how many files had to be featurized
+        '''
+        print('Feature store: {} of {} files new or changed'.format(n_todo,
+                                                                   n_files))
@@ -4,6 +4,7 @@ Functions starting with generate produce single valued integer features
 '''
 import os
 import argparse
+from functools import lru_cache
 import numpy as np
 import pandas as pd
 import pydicom
@@ -25,6 +26,8 @@ from skimage.feature import canny
 from scipy import ndimage
 from skimage.transform import hough_line, hough_line_peaks
 
+from intensity_stats import histogram_of
+
 
 def helper_convert_scale_alpha(maxval):
     '''
@@ -62,6 +65,10 @@ def generate_entropy(original):
     Returns: entropy measure
     '''
     orig_pix = original.pixel_array
+    hist = histogram_of(orig_pix)
+    if hist is not None:
+        return hist.entropy()
+
     orig = orig_pix.ravel()
 
     lensig=orig.size
@@ -110,74 +117,220 @@ def helper_edges(original):
     Returns edges
     '''
     orig = original.pixel_array
+    hist = histogram_of(orig)
 
-    thresh = threshold_mean(orig) # binarise image
+    # binarise image
+    thresh = threshold_mean(orig) if hist is None else hist.mean()
     binary = orig > thresh
     edges = canny(binary, sigma=5)
 
     return edges
 
+# Number of angles over [-pi/2, pi/2] tested by the Hough transform
+HOUGH_ANGLES = 100
+
+@lru_cache(maxsize=None)
+def hough_angles(n_angles):
+    '''
+    Angles tested by the Hough transform, built once and shared by every
+    image. Only the angle array is shared: skimage's hough_line still
+    computes its sin/cos tables on every call. Voting in numpy with cached
+    tables was tried and was several times slower than the Cython
+    hough_line, so the per-image saving comes from restricting the edges to
+    a band around the mass border instead (see
+    create_features.generate_hough).
+    Takes: number of angles over [-pi/2, pi/2]
+    Returns: angle array, shared, so it must not be modified
+    '''
+    theta = np.linspace(-np.pi / 2, np.pi / 2, n_angles)
+    return theta
+
+
+def count_hough_lines(edges, n_angles=HOUGH_ANGLES):
+    '''
+    Number of peaks of the straight line Hough transform, i.e. of lines found
+    Takes: binary edge image and number of angles
+    Returns: number of lines
+    '''
+    h, theta, d = hough_line(edges, theta=hough_angles(n_angles))
+    return len(hough_line_peaks(h, theta, d)[0])
+
+
 def generate_hough(original):
     '''
     Active contour model
         Define segmented mask proportional to the target mass region 
     Returns number of lines
     ''' 
-    orig = original.pixel_array
-    lines = []
     edges = helper_edges(original)  # get edges from canny
-    tested_angles = np.linspace(-np.pi / 2, np.pi / 2, 100) # permute over angles
-    h, theta, d = hough_line(edges, theta=tested_angles)
+    return count_hough_lines(edges)
+
+
+# Snake resolution and stopping: one point per 'spacing' pixels of the
+# initial circle, between min_points and max_points, and at most
+# max_iterations steps (active_contour stops earlier once the contour moves
+# less than 'convergence' pixels). Bump the 'snake' version in
+# create_features.FEATURE_VERSIONS when changing these
+SNAKE_PARAMS = {'spacing': 2,
+                'min_points': 20,
+                'max_points': 200,
+                'max_iterations': 100,
+                'convergence': 0.1}
+
+
+def snake_points(radius, params=SNAKE_PARAMS):
+    '''
+    Number of snake points for a circle, proportional to its perimeter
+    Takes: circle radius and snake parameters
+    Returns: number of points
+    '''
+    n_points = int(round(2 * np.pi * radius / params['spacing']))
+    return int(np.clip(n_points, params['min_points'], params['max_points']))
+
+
+def snake_circle(center, radius, params=SNAKE_PARAMS):
+    '''
+    Initial snake: evenly spaced points on a circle
+    Takes: (row, column) center, radius and snake parameters
+    Returns: (points, 2) array of row, column coordinates
+    '''
+    s = np.linspace(0, 2*np.pi, snake_points(radius, params), endpoint=False)
+    return np.array([center[0] + radius*np.sin(s),
+                     center[1] + radius*np.cos(s)]).T
+
+
+def snake_seed(mask, params=SNAKE_PARAMS):
+    '''
+    Initial snake on the circle with the region's centroid and area
+    (equivalent radius)
+    Takes: region mask and snake parameters
+    Returns: (points, 2) array of row, column coordinates
+    '''
+    rows, cols = np.nonzero(mask)
+    radius = np.sqrt(rows.size / np.pi)
+    return snake_circle((rows.mean(), cols.mean()), radius, params)
+
 
+def fit_snake(smoothed, init, params=SNAKE_PARAMS):
+    '''
+    Runs the active contour from an initial snake
+    Takes: smoothed image, initial snake and snake parameters
+    Returns: mean distance (int) the snake points moved
+    '''
+    snake = active_contour(smoothed, init, alpha=0.015, beta=10, gamma=0.001,
+                           max_iterations=params['max_iterations'],
+                           convergence=params['convergence'],
+                           coordinates='rc')
 
-    origin = np.array((0, orig.shape[1]))
-    for _, angle, dist in zip(*hough_line_peaks(h, theta, d)):
-        y0, y1 = (dist - origin * np.cos(angle)) / np.sin(angle)
-        inter_lines = abs(y0-y1) 
-        lines.append(inter_lines)
-    num_lines = len(lines)
-    return num_lines
+    dist = np.sqrt(np.sum((init - np.asarray(snake)) ** 2, axis=1))
+    return int(np.mean(dist))
 
 
-def generate_snake(original):
+def generate_snake(original, mask=None):
     '''
     Active contour model
         Define segmented mask proportional to the target mass region 
+    Seeded from the region mask if given, otherwise from a fixed circle at
+    (200, 220)
     returns rugged mean dist from defined centroid at r,c
     ''' 
     orig = original.pixel_array
 
-    spic_area = round(0.01*orig.size)
-    s = np.linspace(0, 2*np.pi, spic_area)
-    r = 200 + 100*np.sin(s)
-    c = 220 + 100*np.cos(s)
-    init = np.array([r, c]).T
-    snake = active_contour(gaussian(orig, 3),
-                             init, alpha=0.015, beta=10, gamma=0.001)
+    if mask is None:
+        init = snake_circle((200, 220), 100)
+    else:
+        init = snake_seed(mask)
+    return fit_snake(gaussian(orig, 3), init)
 
-    snake_array = np.asarray(snake)
-    dist = np.sqrt((r-snake_array[:, 0])**2 +(c-snake_array[:, 1])**2)
-    mean_dist = int(np.mean(dist))
-    return mean_dist
 
+# Gabor filter bank: one kernel per orientation x sigma x frequency. Changing
+# the bank changes the gabor columns, so bump the 'gabor' version in
+# create_features.FEATURE_VERSIONS along with it
+GABOR_BANK = {'n_theta': 4, 'sigmas': (1, 3), 'frequencies': (0.05, 0.25)}
 
-def generate_gabor(original):
+
+@lru_cache(maxsize=None)
+def gabor_kernel_bank(n_theta, sigmas, frequencies):
+    '''
+    Builds (once per configuration) the real parts of the Gabor kernels
+    Takes: number of orientations, tuple of sigmas, tuple of frequencies
+    Returns: tuple of 2D kernels
     '''
-    Gabor features
-    '''    
-    orig = original.pixel_array
     kernels = []
-    for theta in range(4):
-        theta = theta / 4. * np.pi
-        for sigma in (1, 3):
-            for frequency in (0.05, 0.25):
+    for theta in range(n_theta):
+        theta = theta / float(n_theta) * np.pi
+        for sigma in sigmas:
+            for frequency in frequencies:
                 kernel = np.real(gabor_kernel(frequency, theta=theta,
                                               sigma_x=sigma, sigma_y=sigma))
                 kernels.append(kernel)
 
+    return tuple(kernels)
+
+
+def gabor_columns(bank=GABOR_BANK):
+    '''
+    Returns: names of the mean/variance feature of every kernel in the bank
+    '''
+    n_kernels = (bank['n_theta'] * len(bank['sigmas']) *
+                 len(bank['frequencies']))
+    return [name.format(k) for k in range(n_kernels)
+            for name in ('gabor_mean_{}', 'gabor_var_{}')]
+
+
+def helper_wrap_kernel(kernel, shape):
+    '''
+    Places a kernel on an image-sized grid with its center at (0, 0), wrapping
+    around the edges, so that its FFT gives circular convolution exactly as
+    ndimage.convolve(..., mode='wrap') does
+    '''
+    padded = np.zeros(shape)
+    rows = (np.arange(kernel.shape[0]) - kernel.shape[0] // 2) % shape[0]
+    cols = (np.arange(kernel.shape[1]) - kernel.shape[1] // 2) % shape[1]
+    np.add.at(padded, np.ix_(rows, cols), kernel)
+
+    return padded
+
+
+def gabor_features(img, bank=GABOR_BANK):
+    '''
+    Mean and variance of the image filtered by every kernel in the bank.
+    The image is transformed once; since mode='wrap' filtering is circular
+    convolution, each filtered image's mean is its DC term and, by
+    Parseval, its variance is the energy of the remaining frequencies, so
+    no inverse transforms are needed.
+    Takes: pixel array
+    Returns: array of shape (n_kernels, 2) with mean and variance
+    '''
+    img = np.asarray(img, dtype=np.float64)
+    n_pixels = img.size
+    spectrum = np.fft.rfft2(img)
+    power = np.abs(spectrum) ** 2
+
+    # rfft2 keeps half of the last axis; every column except the first (and
+    # the Nyquist one for even widths) stands for two conjugate frequencies
+    weights = np.full(spectrum.shape[1], 2.0)
+    weights[0] = 1
+    if img.shape[1] % 2 == 0:
+        weights[-1] = 1
+
+    kernels = gabor_kernel_bank(bank['n_theta'], tuple(bank['sigmas']),
+                                tuple(bank['frequencies']))
     feats = np.zeros((len(kernels), 2), dtype=np.double)
     for k, kernel in enumerate(kernels):
-        filtered = ndimage.convolve(orig, kernel, mode='wrap')
-        feats[k, 0] = filtered.mean()
-        feats[k, 1] = filtered.var()
-    return len(feats)
+        response = np.fft.rfft2(helper_wrap_kernel(kernel, img.shape))
+        energy = power * np.abs(response) ** 2
+        energy[0, 0] = 0
+        feats[k, 0] = (spectrum[0, 0] * response[0, 0]).real / n_pixels
+        feats[k, 1] = np.dot(energy.sum(axis=0), weights) / n_pixels ** 2
+
+    return feats
+
+
+def generate_gabor(original, bank=GABOR_BANK):
+    '''
+    Gabor features
+    Returns: dict with the filtered mean and variance for every kernel
+    '''
+    feats = gabor_features(original.pixel_array, bank)
+    return dict(zip(gabor_columns(bank), feats.ravel()))
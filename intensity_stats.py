@@ -0,0 +1,130 @@
+#============================================================================#
+# HISTOGRAM-BASED INTENSITY STATISTICS
+#============================================================================#
+
+'''
+One integer histogram per image, built with a single bincount pass over the
+unsigned pixel array. Percentiles, the mean threshold, moments and entropy
+are all read off the histogram instead of rescanning (or sorting) every
+pixel, and per-pixel transforms become lookups through a per-level table.
+'''
+
+import weakref
+import numpy as np
+
+# weak reference to the most recent image and its histogram, so that
+# preprocessing and feature generation share it for the same image without
+# keeping the image alive (see histogram_of)
+_last = [None, None]
+
+
+class IntensityHistogram:
+    '''
+    Dense histogram of an unsigned integer image.
+
+    Input:
+        img (numpy array): unsigned integer pixel array
+    '''
+
+    def __init__(self, img):
+        self.counts = np.bincount(np.ravel(img))
+        self.levels = np.arange(self.counts.size, dtype=img.dtype)
+        self.n_pixels = img.size
+        self._cumulative = None
+
+
+    @property
+    def cumulative(self):
+        '''
+        Number of pixels at or below each level
+        '''
+        if self._cumulative is None:
+            self._cumulative = np.cumsum(self.counts)
+        return self._cumulative
+
+
+    def order_statistic(self, k):
+        '''
+        Returns: k-th smallest pixel value (0-based), as np.sort(img)[k]
+        '''
+        return np.searchsorted(self.cumulative, np.asarray(k) + 1)
+
+
+    def percentile(self, q):
+        '''
+        Percentiles with the same linear interpolation as np.percentile
+        Takes: percentile or sequence of percentiles in [0, 100]
+        Returns: float or array of floats
+        '''
+        q = np.asarray(q, dtype=np.float64)
+        index = q / 100 * (self.n_pixels - 1)
+        below = np.floor(index).astype(np.int64)
+        above = np.minimum(below + 1, self.n_pixels - 1)
+        t = index - below
+
+        a = self.order_statistic(below).astype(np.float64)
+        b = self.order_statistic(above).astype(np.float64)
+        diff = b - a
+        result = np.where(t >= 0.5, b - diff * (1 - t), a + diff * t)
+
+        return result[()] if result.ndim == 0 else result
+
+
+    def mean(self, table=None):
+        '''
+        Mean intensity, as np.mean(img) or, given a per-level table, as
+        np.mean(table[img])
+        '''
+        values = self.levels if table is None else table
+        # integer sums are exact, so this matches np.mean to the last bit
+        if values.dtype.kind in 'bui':
+            values = values.astype(np.int64)
+        return np.dot(values, self.counts) / self.n_pixels
+
+
+    def var(self):
+        '''
+        Intensity variance, as np.var(img)
+        '''
+        deviation = self.levels - self.mean()
+        return np.dot(deviation ** 2, self.counts) / self.n_pixels
+
+
+    def std(self):
+        '''
+        Intensity standard deviation, as np.std(img)
+        '''
+        return np.sqrt(self.var())
+
+
+    def entropy(self):
+        '''
+        Shannon entropy (bits) of the intensity distribution
+        '''
+        p = self.counts[self.counts > 0] / (1.0 * self.n_pixels)
+        return np.sum(p * np.log2(1.0 / p))
+
+
+def histogram_of(img):
+    '''
+    Returns the histogram of an image, reusing the previous one when it is
+    called again with the same array object. The pixel array must not be
+    modified in place between calls.
+    Takes: pixel array
+    Returns: IntensityHistogram, or None if the image is not an unsigned
+             integer array of at most 16 bits (wider images would need a
+             histogram with one bin per possible level)
+    '''
+    if img.dtype.kind != 'u' or img.dtype.itemsize > 2:
+        return None
+
+    if _last[0] is None or _last[0]() is not img:
+        _last[0], _last[1] = weakref.ref(img), IntensityHistogram(img)
+    return _last[1]
+
+
+def clear_histogram():
+    '''
+    Drops the histogram kept by histogram_of
+    '''
+    _last[0], _last[1] = None, None
@@ -0,0 +1,105 @@
+#============================================================================#
+# DICOM MANIFEST INDEX
+#============================================================================#
+
+'''
+Builds a compact index of the raw image directories from DICOM headers alone
+(no pixel data is read or decoded). The manifest lets the pipeline filter
+files, join labels and plan work before touching any pixels:
+
+    python manifest.py -dirs raw_train/ raw_test/ -out manifest.csv
+'''
+
+import os
+import argparse
+import pandas as pd
+import pydicom
+
+MANIFEST_COLUMNS = ['path', 'patient_id', 'rows', 'columns', 'bits_stored',
+                    'transfer_syntax', 'size', 'mtime']
+
+
+def read_header(path):
+    '''
+    Reads the header of one DICOM file, stopping before the pixel data
+    Takes: file path
+    Returns: dict with one manifest row, or None if the file is not an image
+    '''
+    ds = pydicom.dcmread(path, force=True, stop_before_pixels=True)
+    if 'Rows' not in ds or 'PatientID' not in ds:
+        return None
+
+    file_meta = getattr(ds, 'file_meta', None)
+    stat = os.stat(path)
+
+    return {'path': path,
+            'patient_id': ds.PatientID,
+            'rows': ds.Rows,
+            'columns': ds.Columns,
+            'bits_stored': ds.get('BitsStored', 0),
+            'transfer_syntax': str(getattr(file_meta, 'TransferSyntaxUID', '')),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime}
+
+
+def build_manifest(img_dirs):
+    '''
+    Scans image directories with header-only reads
+    Takes: list of image directories (ending in '/', as in pipeline.py)
+    Returns: manifest dataframe with one row per DICOM image
+    '''
+    rows = []
+    for img_dir in img_dirs:
+        for file in os.listdir(img_dir):
+            try:
+                row = read_header(img_dir + file)
+            except Exception as e:
+                row = None
+                print('Could not read header: ', file)
+                print(e)
+            if row is not None:
+                rows.append(row)
+
+    return pd.DataFrame(rows, columns=MANIFEST_COLUMNS)
+
+
+def save_manifest(manifest, path):
+    '''
+    Writes a manifest to CSV
+    '''
+    manifest.to_csv(path, index=False)
+
+
+def load_manifest(path):
+    '''
+    Reads a manifest written by save_manifest
+    '''
+    return pd.read_csv(path, dtype={'patient_id': str, 'transfer_syntax': str},
+                       keep_default_na=False, float_precision='round_trip')
+
+
+def plan_files(manifest, img_dir, label_ids=None):
+    '''
+    Selects the files of one directory to featurize, in manifest order
+    Takes: manifest dataframe, image directory, and optionally the ids with
+           labels; images whose PatientID has no label are skipped
+    Returns: list of file names within img_dir
+    '''
+    in_dir = manifest['path'].map(os.path.dirname) == os.path.dirname(img_dir + 'x')
+    selected = manifest[in_dir]
+    if label_ids is not None:
+        selected = selected[selected['patient_id'].isin(set(label_ids))]
+
+    return [os.path.basename(path) for path in selected['path']]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-dirs", "--dirs", nargs="+", required=True, help="Image directories to index")
+    parser.add_argument("-out", "--out", default="manifest.csv", help="Manifest csv file path")
+    args = parser.parse_args()
+
+    manifest = build_manifest(args.dirs)
+    save_manifest(manifest, args.out)
+    print('Indexed {} images into {}'.format(len(manifest), args.out))
@@ -0,0 +1,84 @@
+#============================================================================#
+# SEGMENTATION MASK STORE
+#============================================================================#
+
+'''
+On-disk store for the filled masks produced by preprocess.segment. Masks are
+bit-packed and compressed, and keyed on the image's pixel data together with
+the segmentation parameters, so feature experiments can load a mask instead
+of re-running threshold_img -> apply_ACWE -> ... -> fill_holes. Changing any
+value in preprocess.SEGMENTATION_PARAMS produces new keys.
+'''
+
+import os
+import json
+import hashlib
+import numpy as np
+
+from feature_cache import pixel_digest
+
+
+class MaskStore:
+    '''
+    Directory of bit-packed segmentation masks.
+
+    Input:
+        store_dir (str): directory holding one .npz file per mask
+    '''
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+
+
+    @staticmethod
+    def key(original, params):
+        '''
+        Builds the key for one image segmented with the given parameters
+        Takes: pydicom dataset and dict of segmentation parameters
+        Returns: hex digest string
+        '''
+        params = json.dumps(params, sort_keys=True)
+        return hashlib.sha1('{}:{}'.format(pixel_digest(original),
+                                           params).encode()).hexdigest()
+
+
+    def _path(self, key):
+        '''
+        Location of the mask stored under key
+        '''
+        return os.path.join(self.store_dir, key[:2], key + '.npz')
+
+
+    def load(self, key, lean=False):
+        '''
+        Reads a stored mask
+        Takes: mask key, and whether to return a boolean mask (lean mode)
+        Returns: 0/1 integer mask array, or None if it is not stored
+        '''
+        try:
+            with np.load(self._path(key)) as stored:
+                bits, shape = stored['bits'], tuple(stored['shape'])
+        except (OSError, KeyError, ValueError):
+            return None
+
+        mask = np.unpackbits(bits, count=int(np.prod(shape))).reshape(shape)
+        if lean:
+            return mask.view(bool)
+        return 1 * mask.astype(bool)
+
+
+    def save(self, key, mask):
+        '''
+        Stores a mask, bit-packed and compressed
+        Takes: mask key and 0/1 mask array
+        '''
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write then rename so concurrent workers never see partial files
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, bits=np.packbits(np.asarray(mask, dtype=bool)),
+                                shape=np.array(np.shape(mask)))
+        os.replace(tmp_path, path)
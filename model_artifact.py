@@ -0,0 +1,157 @@
+#============================================================================#
+# PERSISTED MODEL ARTIFACT AND BATCH SCORING
+#============================================================================#
+
+'''
+Saves the model picked by prediction_loop together with everything needed to
+score new images the same way it was trained: the feature groups and their
+version tags, the segmentation parameters, the feature column order and the
+fitted scaler, if any. Scoring a directory of new DICOMs then only
+featurizes the images and applies the model, with no search or refit:
+
+    python model_artifact.py -model best_model.pkl -img_dir new/ -out scores.csv
+'''
+
+import os
+import argparse
+import datetime
+import joblib
+import numpy as np
+import pandas as pd
+
+import preprocess as p
+import pipeline as pipe
+from feature_cache import FeatureCache
+from mask_store import MaskStore
+from pixel_store import PixelStore
+
+ARTIFACT_VERSION = 1
+
+
+def save_artifact(path, model, dataset, features=None):
+    '''
+    Writes a fitted model and its feature schema
+    Takes: output path, model fit on dataset.matrix(), the PreparedDataset
+           it was trained on, and the feature groups used (None for all)
+    '''
+    artifact = {'version': ARTIFACT_VERSION,
+                'created': str(datetime.datetime.now()),
+                'model': model,
+                'features': features,
+                'feature_versions': pipe.feature_versions(features),
+                'segmentation': dict(p.SEGMENTATION_PARAMS),
+                'columns': list(dataset.columns),
+                'scaler': dataset.scaler}
+    joblib.dump(artifact, path)
+
+
+def load_artifact(path):
+    '''
+    Reads an artifact from save_artifact. Warns if the feature code versions
+    changed since it was saved.
+    Takes: artifact path
+    Returns: artifact dict
+    '''
+    artifact = joblib.load(path)
+    if artifact['version'] != ARTIFACT_VERSION:
+        raise ValueError('Unsupported model artifact version: {}'.format(
+            artifact['version']))
+
+    current = pipe.feature_versions(artifact['features'])
+    if current != artifact['feature_versions']:
+        print('Warning: feature versions changed since the model was saved',
+              artifact['feature_versions'], '->', current)
+
+    return artifact
+
+
+def predict_scores(artifact, features_df):
+    '''
+    Applies the artifact's model to a feature table
+    Takes: artifact dict and dataframe with the artifact's feature columns
+    Returns: array of malignancy probabilities (the raw prediction for
+             models without predict_proba)
+    '''
+    X = np.ascontiguousarray(features_df[artifact['columns']].values,
+                             dtype=np.float32)
+    if artifact['scaler'] is not None:
+        X = np.ascontiguousarray(artifact['scaler'].transform(X),
+                                 dtype=np.float32)
+
+    model = artifact['model']
+    if hasattr(model, 'predict_proba'):
+        return model.predict_proba(X)[:, 1]
+    return model.predict(X)
+
+
+def score_directory(artifact, img_dir, n_jobs=1, chunksize=1, cache=None,
+                    masks=None, pixels=None):
+    '''
+    Featurizes a directory of DICOMs and scores them. Images are segmented
+    with the artifact's segmentation parameters, as the training images
+    were.
+
+    Input:
+        artifact (dict): artifact from load_artifact
+        img_dir (str): image directory
+        n_jobs (int): number of worker processes, 1 runs serially
+        chunksize (int): number of images handed to a worker at a time
+        cache (FeatureCache): optional cache of previously computed features
+        masks (MaskStore): optional store of previously computed masks
+        pixels (PixelStore): optional memory-mapped pixel store
+
+    Output:
+        scores (df): file, id and probability per image that could be
+                     processed
+    '''
+    img_dir = os.path.join(img_dir, '')
+    list_of_files = os.listdir(img_dir)
+    rows = pipe.FeatureAccumulator(pipe.feature_columns(artifact['features']),
+                                   len(list_of_files))
+    files = []
+    results = pipe.iter_features(img_dir, list_of_files, n_jobs, chunksize,
+                                 cache=cache, masks=masks, pixels=pixels,
+                                 features=artifact['features'],
+                                 params=artifact['segmentation'])
+    for file, props, error, _, _ in results:
+        if error is None:
+            rows.add(props)
+            files.append(file)
+        else:
+            print('Could not process: ', file)
+            print(error)
+
+    df = rows.to_frame()
+    scores = pd.DataFrame({'file': files, 'id': df['id']})
+    scores['probability'] = predict_scores(artifact, df) if len(df) else []
+
+    return scores
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-model", "--model", default="best_model.pkl", help="Model artifact saved by prediction_loop.py")
+    parser.add_argument("-img_dir", "--img_dir", required=True, help="Directory of DICOM images to score")
+    parser.add_argument("-out", "--out", default="scores.csv", help="Output csv file path")
+    parser.add_argument("-n_jobs", "--n_jobs", type=int, default=1, help="Number of featurization worker processes")
+    parser.add_argument("-chunksize", "--chunksize", type=int, default=1, help="Images handed to a worker at a time")
+    parser.add_argument("-cache_dir", "--cache_dir", default="", help="Feature cache directory")
+    parser.add_argument("-cache_mb", "--cache_mb", type=int, default=1024, help="Feature cache size limit in MB")
+    parser.add_argument("-mask_dir", "--mask_dir", default="", help="Segmentation mask store directory")
+    parser.add_argument("-pixel_dir", "--pixel_dir", default="", help="Pixel store directory from pixel_store.py")
+    args = parser.parse_args()
+
+    artifact = load_artifact(args.model)
+    cache = FeatureCache(args.cache_dir, args.cache_mb * 1024 ** 2) \
+        if args.cache_dir else None
+    scores = score_directory(artifact, args.img_dir, args.n_jobs,
+                             args.chunksize, cache,
+                             MaskStore(args.mask_dir) if args.mask_dir else None,
+                             PixelStore(args.pixel_dir) if args.pixel_dir else None)
+    scores.to_csv(args.out, index=False)
+    print('Scored {} images into {}'.format(len(scores), args.out))
+
+    if cache is not None:
+        cache.prune()
+        cache.report()
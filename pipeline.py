@@ -9,7 +9,12 @@ and training data.
 '''
 
 import os
+import json
+import hashlib
 import argparse
+import multiprocessing as mp
+from collections import deque
+from functools import partial
 import numpy as np
 import pandas as pd
 import pydicom
@@ -23,27 +28,424 @@ from sklearn.utils.testing import ignore_warnings
 
 import preprocess as p
 import create_features as cf
+from feature_cache import FeatureCache, DEFAULT_MAX_BYTES
+from mask_store import MaskStore
+import manifest as mf
+from pixel_store import PixelStore
+from region_geometry import RegionGeometry
+from feature_store import FeatureStore
+from watchdog_pool import Watchdog
 
 pd.set_option('display.max_columns', 500)
+
+
+REGION_PROPERTIES = ['area', # Num of pixels in region
+                     'convex_area', # Num pixels in smallest convex polygon that encloses region
+                     'eccentricity', # Eccentricity of the ellipse that has the same second-moments as the region
+                     'equivalent_diameter', # Diameter of circle with same area as region
+                     'major_axis_length', # Length of major axis
+                     'minor_axis_length', # Length of minor axis
+                     'perimeter']
+
+# Version tag of the region property group, see cf.FEATURE_VERSIONS
+REGION_VERSION = 1
+
+
+
+def feature_versions(features=None):
+    '''
+    Version tags of the selected feature groups, in output order
+    Takes: list of groups ('region' or keys of cf.FEATURE_VERSIONS), None
+           for all of them
+    Returns: dict of feature group to version tag
+    '''
+    versions = {'region': REGION_VERSION}
+    versions.update(cf.FEATURE_VERSIONS)
+    if features is None:
+        return versions
+
+    unknown = set(features) - set(versions)
+    if unknown:
+        raise ValueError('Unknown features: ' + ', '.join(sorted(unknown)))
+
+    return {group: versions[group] for group in versions if group in features}
+
+
+def feature_columns(features=None):
+    '''
+    Numeric feature columns of the selected groups, in output order
+    Takes: list of feature groups, None for all of them
+    '''
+    columns = []
+    for group in feature_versions(features):
+        if group == 'region':
+            columns += REGION_PROPERTIES
+        else:
+            columns += cf.FEATURE_COLUMNS[group]
+
+    return columns
+
+
+# Fixed schema of numeric feature columns, in output order
+FEATURE_COLUMNS = feature_columns()
+
+
+def store_signature(features=None):
+    '''
+    Identifies what a stored feature table was computed with: the selected
+    feature groups with their version tags and the segmentation parameters
+    Takes: list of feature groups, None for all of them
+    Returns: hex digest string
+    '''
+    settings = {'versions': feature_versions(features),
+                'segmentation': p.SEGMENTATION_PARAMS}
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+class FeatureAccumulator:
+    '''
+    Collects feature rows into preallocated float columns and builds a single
+    DataFrame at the end, instead of copying a growing frame on every append.
+
+    Input:
+        columns (lst): numeric feature columns, in output order
+        capacity (int): expected number of rows, grown if exceeded
+    '''
+
+    def __init__(self, columns, capacity):
+        self.columns = list(columns)
+        self.values = np.empty((len(self.columns), max(capacity, 1)))
+        self.ids = np.empty(max(capacity, 1), dtype=object)
+        self.n_rows = 0
+
+
+    def add(self, props):
+        '''
+        Appends one feature row
+        Takes: dict with a value for every column plus 'id'
+        '''
+        if self.n_rows == self.ids.size:
+            self.values = np.hstack((self.values, np.empty_like(self.values)))
+            self.ids = np.concatenate((self.ids, np.empty_like(self.ids)))
+
+        # read every value before writing so a bad row leaves no trace
+        row = [props[column] for column in self.columns]
+        self.values[:, self.n_rows] = row
+        self.ids[self.n_rows] = props['id']
+        self.n_rows += 1
+
+
+    def to_frame(self):
+        '''
+        Returns: pandas dataframe of the rows added so far
+        '''
+        data = {column: self.values[j, :self.n_rows]
+                for j, column in enumerate(self.columns)}
+        data['id'] = self.ids[:self.n_rows]
+
+        return pd.DataFrame(data, columns=self.columns + ['id'])
+
+
 @ignore_warnings(category=FutureWarning)
-def properties(img_dir, csv_path):
+def featurize_file(full_path, cache=None, masks=None, pixels=None,
+                   stats=None, features=None, progress=None, params=None):
+    '''
+    Pre-processes a single image and calculates its feature row.
+
+    Input:
+        full_path (str): path to a DICOM image
+        cache (FeatureCache): optional cache of previously computed features
+        masks (MaskStore): optional store of previously computed masks
+        pixels (PixelStore): optional memory-mapped pixel store
+        stats (dict): optional dict that receives the number of ACWE
+                      iterations used, see p.segment_pixels
+        features (lst): feature groups to compute, None for all
+        progress (function): optional, called with the name of each stage
+                             ('read', 'segment', then the feature groups)
+                             as it starts
+        params (dict): segmentation parameters, None for
+                       p.SEGMENTATION_PARAMS
+
+    Output:
+        props (dict): region properties, manual features, and patient id
+    '''
+    if progress is None:
+        progress = lambda stage: None
+    if params is None:
+        params = p.SEGMENTATION_PARAMS
+
+    progress('read')
+    original = p.read_image(full_path, pixels)
+    versions = feature_versions(features)
+
+    groups = {}
+    if cache is not None:
+        digest = cache.digest(original, params)
+        for feature, version in versions.items():
+            values = cache.get(digest, feature, version)
+            if values is not None:
+                groups[feature] = values
+
+    missing = [feature for feature in versions if feature not in groups]
+    if missing:
+        progress('segment')
+        filled_img = p.segment(original, masks, stats, params)
+        # labeled and measured once for the region properties and circularity
+        geometry = None
+        computed = {}
+        if 'region' in missing:
+            progress('region')
+            geometry = RegionGeometry(filled_img)
+            computed['region'] = geometry.table(REGION_PROPERTIES)
+
+        # manual feature generation from create_features
+        manual = [feature for feature in missing if feature != 'region']
+        if manual:
+            manual_features = cf.make_all_features(original, filled_img, manual,
+                                                   geometry=geometry,
+                                                   progress=progress)
+            for feature in manual:
+                computed[feature] = {f: manual_features[f]
+                                     for f in cf.FEATURE_COLUMNS[feature]}
+
+        for feature in computed:
+            if cache is not None:
+                cache.put(digest, feature, versions[feature], computed[feature])
+            groups[feature] = computed[feature]
+
+    props = {}
+    for feature in versions:
+        props.update(groups[feature])
+
+    # include id
+    props['id'] = original.PatientID
+
+    return props
+
+
+def featurize_file_safe(full_path, cache=None, masks=None, pixels=None,
+                        features=None, progress=None, params=None):
+    '''
+    Wraps featurize_file so that a failure on one image is returned rather
+    than raised. Keeps one bad file from taking down a worker pool.
+
+    Input:
+        full_path (str): path to a DICOM image
+        cache (FeatureCache): optional feature cache
+        masks (MaskStore): optional segmentation mask store
+        pixels (PixelStore): optional memory-mapped pixel store
+        features (lst): feature groups to compute, None for all
+        progress (function): optional stage callback, see featurize_file
+        params (dict): segmentation parameters, None for
+                       p.SEGMENTATION_PARAMS
+
+    Output:
+        (props, error, counts, iterations) (tuple): feature row and None on
+            success, or None and the error message on failure, plus cache
+            hit/miss counts and the number of full resolution ACWE
+            iterations used (None if the image was not segmented)
+    '''
+    stats = {}
+    try:
+        props = featurize_file(full_path, cache, masks, pixels, stats,
+                               features, progress, params)
+        error = None
+    except Exception as e:
+        props, error = None, str(e)
+
+    counts = cache.take_counts() if cache is not None else (0, 0)
+    return props, error, counts, stats.get('acwe_iterations')
+
+
+def featurize_chunk(featurize, paths):
+    '''
+    Runs featurize over a list of images in one worker task
+    Takes: featurize_file_safe partial and list of image paths
+    Returns: list of featurize_file_safe results
+    '''
+    return [featurize(path) for path in paths]
+
+
+def iter_features(img_dir, list_of_files=None, n_jobs=1, chunksize=1,
+                  window=None, cache=None, masks=None, pixels=None,
+                  features=None, timeout=None, stage_timeouts=None,
+                  params=None):
+    '''
+    Featurizes a directory of images one at a time, yielding each result as
+    soon as it is ready so that callers can write, monitor or model rows
+    while the rest are still running. Results come back in input order.
+    With several workers at most window images are in flight, so memory does
+    not grow with the size of the directory.
+
+    With a timeout or stage timeouts every image runs in a supervised worker
+    process (even with n_jobs=1) that is killed and replaced when it
+    overruns its budget; see watchdog_pool.py.
+
+    Input:
+        img_dir (str): image directory
+        list_of_files (lst): file names in img_dir, None lists the directory
+        n_jobs (int): number of worker processes, 1 runs serially
+        chunksize (int): number of images handed to a worker at a time
+        window (int): most images submitted but not yet yielded, None for
+                      two chunks per worker
+        cache (FeatureCache): optional cache of previously computed features
+        masks (MaskStore): optional store of previously computed masks
+        pixels (PixelStore): optional memory-mapped pixel store
+        features (lst): feature groups to compute, None for all
+        timeout (float): seconds one image may take, None for no limit
+        stage_timeouts (dict): stage name ('read', 'segment', 'region' or a
+                               feature group) -> seconds it may take
+        params (dict): segmentation parameters, None for
+                       p.SEGMENTATION_PARAMS; handed to the workers, so
+                       they apply even where workers re-import preprocess
+
+    Output:
+        generator of (file, props, error, iterations, timed_out) tuples;
+        the first four as from featurize_file_safe, timed_out is the stage
+        that overran its budget or None
+    '''
+    if list_of_files is None:
+        list_of_files = os.listdir(img_dir)
+    featurize = partial(featurize_file_safe, cache=cache, masks=masks,
+                        pixels=pixels, features=features, params=params)
+
+    def results():
+        if timeout is not None or stage_timeouts:
+            watchdog = Watchdog(featurize, n_jobs, timeout, stage_timeouts)
+            supervised = watchdog.imap([img_dir + file
+                                        for file in list_of_files], window)
+            for file, (result, failure) in zip(list_of_files, supervised):
+                if failure is None:
+                    yield file, result + (None,)
+                    continue
+                kind, stage = failure
+                if kind == 'timeout':
+                    yield file, (None, 'Timed out in stage ' + stage, (0, 0),
+                                 None, stage)
+                else:
+                    yield file, (None, 'Worker died in stage ' + stage,
+                                 (0, 0), None, None)
+            return
+
+        if n_jobs <= 1:
+            for file in list_of_files:
+                yield file, featurize(img_dir + file) + (None,)
+            return
+
+        size = window or 2 * n_jobs * chunksize
+        max_chunks = max(size // chunksize, 1)
+        pending = deque()
+        with mp.Pool(processes=n_jobs) as pool:
+            for start in range(0, len(list_of_files), chunksize):
+                chunk = list_of_files[start:start + chunksize]
+                task = pool.apply_async(featurize_chunk,
+                                        (featurize, [img_dir + file
+                                                     for file in chunk]))
+                pending.append((chunk, task))
+                # wait on the oldest chunk so results stay in input order
+                if len(pending) >= max_chunks:
+                    chunk, task = pending.popleft()
+                    for file, result in zip(chunk, task.get()):
+                        yield file, result + (None,)
+            while pending:
+                chunk, task = pending.popleft()
+                for file, result in zip(chunk, task.get()):
+                    yield file, result + (None,)
+
+    for file, (props, error, counts, used, timed_out) in results():
+        if cache is not None:
+            cache.add_counts(counts)
+        yield file, props, error, used, timed_out
+
+
+def report_iterations(iterations):
+    '''
+    Prints how many ACWE iterations each segmented image used at full
+    resolution (the refinement only, in pyramid mode), as a count of images
+    per number of iterations, then each image that stopped short of the most
+    iterations used
+    Takes: dict of file name to iterations used
+    '''
+    if not iterations:
+        return
+
+    used = pd.Series(iterations)
+    print('ACWE iterations used (iterations: images):',
+          used.value_counts().sort_index().to_dict())
+    early = used[used < used.max()]
+    for file, n in early.items():
+        print('  {}: {}'.format(file, n))
+
+
+def parse_stage_timeouts(text):
+    '''
+    Parses stage time budgets given on the command line
+    Takes: string like 'segment=120,snake=60'
+    Returns: dict of stage name to seconds, None for an empty string
+    '''
+    if not text:
+        return None
+
+    budgets = {}
+    for item in text.split(','):
+        stage, seconds = item.split('=')
+        budgets[stage.strip()] = float(seconds)
+    return budgets
+
+
+def report_timeouts(timeouts):
+    '''
+    Prints the images that ran over their time budget, grouped by the stage
+    that overran
+    Takes: dict of file name to stage
+    '''
+    if not timeouts:
+        return
+
+    stages = pd.Series(timeouts)
+    print('Timed out images (stage: images):',
+          stages.value_counts().sort_index().to_dict())
+    for file, stage in stages.items():
+        print('  {}: {}'.format(file, stage))
+
+
+@ignore_warnings(category=FutureWarning)
+def properties(img_dir, csv_path, n_jobs=1, chunksize=1, cache=None,
+               masks=None, manifest=None, pixels=None, features=None,
+               store=None, timeout=None, stage_timeouts=None):
     '''
     Calculates a pre-processed feature set given a directory of images.
 
     Input:
         img_dir (str): image directory
         csv_path (str): location of training labels stored in a CSV
+        n_jobs (int): number of worker processes, 1 runs serially
+        chunksize (int): number of images handed to a worker at a time
+        cache (FeatureCache): optional cache of previously computed features
+        masks (MaskStore): optional store of previously computed masks
+        manifest (df): optional header index from manifest.py; when given,
+                       files are planned from it and unlabeled images skipped
+        pixels (PixelStore): optional memory-mapped pixel store
+        features (lst): feature groups to compute ('region' or keys of
+                        cf.FEATURE_VERSIONS), None for all
+        store (FeatureStore): optional table of previously featurized files;
+                              only new or changed files are featurized and
+                              the store is updated
+        timeout (float): seconds one image may take, None for no limit
+        stage_timeouts (dict): seconds each stage may take, see iter_features
 
     Output:
         full_data (df): a pandas dataframe containing patient_id, features,
                         and pathology
     '''
-    list_of_files = os.listdir(img_dir)
-    df = pd.DataFrame()
-
     labels = pd.read_csv(csv_path)
     labels['id'] = labels['cropped image file path'].str.split('/').str[0] 
 
+    if manifest is None:
+        list_of_files = os.listdir(img_dir)
+    else:
+        list_of_files = mf.plan_files(manifest, img_dir, labels['id'])
+
     # drop extraneous metadata columns
     labels.drop(columns = ['patient_id', 'breast_density', \
     'left or right breast', 'image view', \
@@ -51,34 +453,40 @@ def properties(img_dir, csv_path):
     'assessment', 'subtlety', 'image file path', 'cropped image file path', \
     'ROI mask file path'], inplace=True)
 
-    for file in list_of_files:
-        try:
-            full_path = img_dir + file
-            filled_img, original = p.go(full_path)
-            label_image = label(filled_img)
-            props = regionprops_table(label_image,
-                                        properties=['area', # Num of pixels in region
-                                                    'convex_area', # Num pixels in smallest convex polygon that encloses region
-                                                    'eccentricity', # Eccentricity of the ellipse that has the same second-moments as the region
-                                                    'equivalent_diameter', # Diameter of circle with same area as region
-                                                    'major_axis_length', # Length of major axis
-                                                    'minor_axis_length', # Length of minor axis
-                                                    'perimeter'])
-
-            # manual feature generation from create_features
-            manual_features = cf.make_all_features(original, filled_img)
-            for f in manual_features.keys():
-                props[f] = manual_features[f]
-
-            for key in props: 
-                props[key] = float(props[key]) 
-            # include id
-            props['id'] = original.PatientID
-            df = df.append(props, ignore_index=True)
-    
-        except Exception as e:
+    full_paths = [img_dir + file for file in list_of_files]
+    if store is not None:
+        todo = set(store.plan(full_paths))
+        list_of_files = [file for file, path in zip(list_of_files, full_paths)
+                         if path in todo]
+    paths = [img_dir + file for file in list_of_files]
+    rows = FeatureAccumulator(feature_columns(features), len(list_of_files))
+
+    iterations = {}
+    timeouts = {}
+    done = []
+    results = iter_features(img_dir, list_of_files, n_jobs, chunksize,
+                            cache=cache, masks=masks, pixels=pixels,
+                            features=features, timeout=timeout,
+                            stage_timeouts=stage_timeouts)
+    for file, props, error, used, timed_out in results:
+        if timed_out is not None:
+            timeouts[file] = timed_out
+        if used is not None:
+            iterations[file] = used
+        if error is None:
+            rows.add(props)
+            done.append(img_dir + file)
+        else:
             print('Could not process: ', file)
-            print(e)
+            print(error)
+    df = rows.to_frame()
+    report_iterations(iterations)
+    report_timeouts(timeouts)
+
+    if store is not None:
+        df['path'] = done
+        df = store.update(img_dir, full_paths, paths, df)
+        store.report(len(full_paths), len(paths))
 
     
     # Optional: standardize numeric columns
@@ -101,7 +509,10 @@ def properties(img_dir, csv_path):
     return full_data
 
 
-def go(train_path, train_csv, test_path=None, test_csv=None):
+def go(train_path, train_csv, test_path=None, test_csv=None, n_jobs=1,
+       chunksize=1, cache_dir=None, cache_size=DEFAULT_MAX_BYTES,
+       mask_dir=None, manifest_path=None, pixel_dir=None, features=None,
+       store_dir=None, timeout=None, stage_timeouts=None):
     '''
     Creates training and testing features.
 
@@ -110,6 +521,20 @@ def go(train_path, train_csv, test_path=None, test_csv=None):
         train_csv (str): training labels csv
         test_path (str): testing images path
         test_csv (str): testing labels csv
+        n_jobs (int): number of worker processes used for featurization
+        chunksize (int): number of images handed to a worker at a time
+        cache_dir (str): feature cache directory, None disables caching
+        cache_size (int): feature cache size limit in bytes
+        mask_dir (str): segmentation mask store directory, None disables it
+        manifest_path (str): manifest csv from manifest.py, None lists the
+                             image directories instead
+        pixel_dir (str): pixel store directory from pixel_store.py, None
+                         decodes every DICOM
+        features (lst): feature groups to compute, None for all
+        store_dir (str): incremental feature store directory, None
+                         featurizes every file
+        timeout (float): seconds one image may take, None for no limit
+        stage_timeouts (dict): seconds each stage may take, see iter_features
 
     Return:
         train_data (df): pandas dataframe, including id, features, and label
@@ -117,10 +542,24 @@ def go(train_path, train_csv, test_path=None, test_csv=None):
                         Note: if parameters set to None, will return None.
     '''
     test_data = None
-    train_data = properties(train_path, train_csv)
+    cache = FeatureCache(cache_dir, cache_size) if cache_dir else None
+    masks = MaskStore(mask_dir) if mask_dir else None
+    manifest = mf.load_manifest(manifest_path) if manifest_path else None
+    pixels = PixelStore(pixel_dir) if pixel_dir else None
+    store = FeatureStore(store_dir, store_signature(features)) \
+        if store_dir else None
+    train_data = properties(train_path, train_csv, n_jobs, chunksize, cache,
+                            masks, manifest, pixels, features, store,
+                            timeout, stage_timeouts)
 
     if test_path and test_csv:
-        test_data = properties(test_path, test_csv)
+        test_data = properties(test_path, test_csv, n_jobs, chunksize, cache,
+                               masks, manifest, pixels, features, store,
+                               timeout, stage_timeouts)
+
+    if cache is not None:
+        cache.prune()
+        cache.report()
     
     return train_data, test_data
 
@@ -132,9 +571,31 @@ if __name__ == "__main__":
     parser.add_argument("-train_csv", "--train_csv", default="", help="Training csv file path")
     parser.add_argument("-test", "--test", default="", help = "Test image file path")
     parser.add_argument("-test_csv", "--test_csv", default="", help ="Testing csv file path")
+    parser.add_argument("-n_jobs", "--n_jobs", type=int, default=1, help="Number of featurization worker processes")
+    parser.add_argument("-chunksize", "--chunksize", type=int, default=1, help="Images handed to a worker at a time")
+    parser.add_argument("-cache_dir", "--cache_dir", default="", help="Feature cache directory")
+    parser.add_argument("-cache_mb", "--cache_mb", type=int, default=1024, help="Feature cache size limit in MB")
+    parser.add_argument("-mask_dir", "--mask_dir", default="", help="Segmentation mask store directory")
+    parser.add_argument("-manifest", "--manifest", default="", help="Manifest csv file path from manifest.py")
+    parser.add_argument("-pixel_dir", "--pixel_dir", default="", help="Pixel store directory from pixel_store.py")
+    parser.add_argument("-features", "--features", default="", help="Comma-separated feature groups to compute, e.g. region,spiculation,circularity (default all)")
+    parser.add_argument("-store_dir", "--store_dir", default="", help="Incremental feature store directory; only new or changed files are featurized")
+    parser.add_argument("-timeout", "--timeout", type=float, default=0, help="Seconds one image may take before its worker is killed (default no limit)")
+    parser.add_argument("-stage_timeouts", "--stage_timeouts", default="", help="Per-stage time budgets in seconds, e.g. segment=120,snake=60")
     args = parser.parse_args()
 
     try:
-        train, test, test_labels = go(args.train, args.train_csv)
+        train, test, test_labels = go(args.train, args.train_csv,
+                                      n_jobs=args.n_jobs,
+                                      chunksize=args.chunksize,
+                                      cache_dir=args.cache_dir,
+                                      cache_size=args.cache_mb * 1024 ** 2,
+                                      mask_dir=args.mask_dir,
+                                      manifest_path=args.manifest,
+                                      pixel_dir=args.pixel_dir,
+                                      features=args.features.split(',') if args.features else None,
+                                      store_dir=args.store_dir,
+                                      timeout=args.timeout or None,
+                                      stage_timeouts=parse_stage_timeouts(args.stage_timeouts))
     except Exception as e:
         print(e)
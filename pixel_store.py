@@ -0,0 +1,173 @@
+#============================================================================#
+# MEMORY-MAPPED PIXEL STORE
+#============================================================================#
+
+'''
+One-time conversion of the DICOM corpus into a single flat uint16 file plus
+an offset/shape index. Reading an image from the store is a zero-copy view
+into a read-only memory map, so there is no DICOM decoding on later runs and
+parallel workers share pages through the OS cache:
+
+    python pixel_store.py -manifest manifest.csv -out pixel_store/
+
+ImageView mimics the parts of a pydicom dataset the pipeline uses
+(pixel_array, PatientID, PixelData), so it can be handed to preprocess and
+create_features unchanged. The index keeps the digest of each source file's
+PixelData, so feature and mask cache keys do not depend on whether an image
+was read from its DICOM file or from the store.
+'''
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import pydicom
+
+import manifest as mf
+from feature_cache import pixel_digest
+
+PIXEL_DTYPE = np.dtype('<u2')
+PIXELS_FILE = 'pixels.u16'
+INDEX_FILE = 'index.csv'
+
+
+class ImageView:
+    '''
+    Stand-in for a pydicom dataset backed by an existing pixel array, such as
+    a view into a PixelStore or an ROI crop (see create_features.crop_image).
+
+    Input:
+        pixel_array (numpy array): pixel array, typically a view
+        patient_id (str): DICOM PatientID
+        digest (str): pixel_digest of the source dataset, if known
+    '''
+
+    def __init__(self, pixel_array, patient_id, digest=None):
+        self.pixel_array = pixel_array
+        self.PatientID = patient_id
+        self.digest = digest
+
+
+    @property
+    def PixelData(self):
+        '''
+        Raw little-endian bytes of the pixel array. These only equal the
+        source's PixelData for uncompressed 16-bit images, which is why
+        pixel_digest prefers the stored digest.
+        '''
+        return self.pixel_array.data
+
+
+def convert(manifest, store_dir):
+    '''
+    Decodes every image in a manifest once and appends it to the store
+    Takes: manifest dataframe (see manifest.py) and output directory
+    Returns: index dataframe with the offset and shape of each image
+    '''
+    os.makedirs(store_dir, exist_ok=True)
+    rows = []
+    offset = 0
+
+    with open(os.path.join(store_dir, PIXELS_FILE), 'wb') as f:
+        for _, entry in manifest.iterrows():
+            try:
+                dataset = pydicom.dcmread(entry['path'], force=True)
+                pixels = dataset.pixel_array
+                if pixels.dtype.kind != 'u' or pixels.dtype.itemsize > 2:
+                    raise ValueError('unsupported pixel type ' + str(pixels.dtype))
+                digest = pixel_digest(dataset)
+            except Exception as e:
+                print('Could not convert: ', entry['path'])
+                print(e)
+                continue
+
+            f.write(np.ascontiguousarray(pixels, dtype=PIXEL_DTYPE).tobytes())
+            rows.append({'path': os.path.normpath(entry['path']),
+                         'patient_id': entry['patient_id'],
+                         'digest': digest,
+                         'offset': offset,
+                         'rows': pixels.shape[0],
+                         'columns': pixels.shape[1],
+                         'size': entry['size'],
+                         'mtime': entry['mtime']})
+            offset += pixels.size
+
+    index = pd.DataFrame(rows, columns=['path', 'patient_id', 'digest',
+                                        'offset', 'rows', 'columns', 'size',
+                                        'mtime'])
+    index.to_csv(os.path.join(store_dir, INDEX_FILE), index=False)
+
+    return index
+
+
+class PixelStore:
+    '''
+    Read-only access to a store written by convert(). The memory map is
+    opened lazily and not pickled, so the object is cheap to send to worker
+    processes.
+
+    Input:
+        store_dir (str): directory written by convert()
+    '''
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        index = pd.read_csv(os.path.join(store_dir, INDEX_FILE),
+                            dtype={'patient_id': str, 'digest': str},
+                            keep_default_na=False,
+                            float_precision='round_trip')
+        self.index = {row['path']: row for row in index.to_dict('records')}
+        self._pixels = None
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pixels'] = None
+        return state
+
+
+    @property
+    def pixels(self):
+        '''
+        Flat memory map over every stored pixel
+        '''
+        if self._pixels is None:
+            path = os.path.join(self.store_dir, PIXELS_FILE)
+            if os.path.getsize(path) == 0:
+                self._pixels = np.zeros(0, dtype=PIXEL_DTYPE)
+            else:
+                self._pixels = np.memmap(path, dtype=PIXEL_DTYPE, mode='r')
+        return self._pixels
+
+
+    def lookup(self, path):
+        '''
+        Finds an image in the store
+        Takes: path of the source DICOM file
+        Returns: ImageView, or None if the file was not converted or has
+                 changed on disk since
+        '''
+        entry = self.index.get(os.path.normpath(path))
+        if entry is None:
+            return None
+
+        stat = os.stat(path)
+        if stat.st_size != entry['size'] or stat.st_mtime != entry['mtime']:
+            return None
+
+        start = entry['offset']
+        view = self.pixels[start:start + entry['rows'] * entry['columns']]
+
+        return ImageView(view.reshape(entry['rows'], entry['columns']),
+                         entry['patient_id'], entry.get('digest') or None)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-manifest", "--manifest", required=True, help="Manifest csv file path from manifest.py")
+    parser.add_argument("-out", "--out", default="pixel_store/", help="Pixel store directory")
+    args = parser.parse_args()
+
+    index = convert(mf.load_manifest(args.manifest), args.out)
+    print('Stored {} images in {}'.format(len(index), args.out))
@@ -18,7 +18,8 @@ import argparse
 import textwrap
 import matplotlib.pyplot as plt
 
-from sklearn.model_selection import cross_val_score
+from joblib import Parallel, delayed
+from sklearn.base import clone, is_classifier
 from sklearn.model_selection import ParameterGrid
 from sklearn.linear_model import LogisticRegression
 from sklearn.neighbors import KNeighborsClassifier
@@ -31,21 +32,324 @@ from sklearn.utils.testing import ignore_warnings
 from sklearn.exceptions import ConvergenceWarning
 from sklearn import metrics
 from sklearn.metrics import (classification_report, precision_recall_curve,
-                             roc_auc_score, plot_roc_curve)
+                             roc_auc_score, plot_roc_curve, get_scorer)
 import pipeline as pipe
+from prepared_dataset import PreparedDataset
+from model_artifact import save_artifact
+
+N_FOLDS = 5
+# ensembles whose n_estimators grid is traversed by growing one ensemble
+WARM_START_MODELS = (BaggingClassifier, GradientBoostingClassifier,
+                     AdaBoostClassifier)
+
+
+@ignore_warnings(category=ConvergenceWarning)
+@ignore_warnings(category=FutureWarning)
+def score_fold(model, parameter, fold, scorer):
+    '''
+    Fits one configuration on one cross-validation fold and scores it, as
+    cross_val_score does for each of its folds (a failed fit scores nan)
+
+    Input:
+        model (obj): scikit-learn model, cloned before fitting
+        parameter (dict): hyperparameter values
+        fold (tuple): X_train, y_train, X_test, y_test from
+                      PreparedDataset.folds
+        scorer (obj): scikit-learn scorer
+
+    Output:
+        (score, seconds) (tuple): fold score and time spent on it
+    '''
+    s = timeit.default_timer()
+    X_train, y_train, X_test, y_test = fold
+    estimator = clone(model).set_params(**parameter)
+    try:
+        estimator.fit(X_train, y_train)
+        score = scorer(estimator, X_test, y_test)
+    except Exception:
+        score = np.nan
+
+    return score, timeit.default_timer() - s
+
+
+def staged_values(values, counts):
+    '''
+    Picks the staged decision values at the given ensemble sizes. A
+    boosting run that stopped early repeats its last stage, as a fresh fit
+    with more estimators would stop at the same point.
+    Takes: iterator of decision values per stage, sorted ensemble sizes
+    Returns: list of 1D decision value arrays, one per size
+    '''
+    picked = []
+    for stage, value in enumerate(values, 1):
+        if stage == counts[len(picked)]:
+            picked.append(np.ravel(value))
+            if len(picked) == len(counts):
+                break
+    while len(picked) < len(counts):
+        picked.append(np.ravel(value))
+    return picked
+
+
+@ignore_warnings(category=ConvergenceWarning)
+@ignore_warnings(category=FutureWarning)
+def score_path(model, parameters, fold, scorer):
+    '''
+    Scores configurations that differ only in n_estimators on one fold at
+    about the cost of the largest one. Bagging grows one warm-started
+    ensemble; boosting fits the largest ensemble once and scores the
+    smaller ones from its staged decision function (AUC of the decision
+    function, as the roc_auc scorer computes it). A single configuration
+    falls back to score_fold.
+
+    Input:
+        model (obj): scikit-learn model, cloned before fitting
+        parameters (lst): hyperparameter dicts, by increasing n_estimators
+        fold (tuple): X_train, y_train, X_test, y_test
+        scorer (obj): scikit-learn scorer
+
+    Output:
+        list of (score, seconds) per configuration; the time of a shared
+        fit is split in proportion to the estimators each one adds
+    '''
+    if len(parameters) == 1:
+        return [score_fold(model, parameters[0], fold, scorer)]
+
+    s = timeit.default_timer()
+    X_train, y_train, X_test, y_test = fold
+    counts = [parameter['n_estimators'] for parameter in parameters]
+    estimator = clone(model).set_params(**parameters[-1])
+    try:
+        if isinstance(estimator, BaggingClassifier):
+            estimator.set_params(warm_start=True)
+            results = []
+            for parameter in parameters:
+                estimator.set_params(**parameter)
+                estimator.fit(X_train, y_train)
+                score = scorer(estimator, X_test, y_test)
+                results.append((score, timeit.default_timer() - s))
+                s = timeit.default_timer()
+            return results
+
+        estimator.fit(X_train, y_train)
+        values = staged_values(estimator.staged_decision_function(X_test),
+                               counts)
+        scores = [roc_auc_score(y_test, value) for value in values]
+    except Exception:
+        scores = [np.nan] * len(counts)
+
+    seconds = timeit.default_timer() - s
+    added = np.diff([0] + counts)
+    return [(score, seconds * n / counts[-1])
+            for score, n in zip(scores, added)]
+
+
+def estimator_paths(models, configs, indices, warm_start=True):
+    '''
+    Groups configurations of ensemble models that differ only in
+    n_estimators, so that score_path can grow one ensemble through all of
+    their sizes. Every other configuration is a group of its own.
+    Takes: dict of models, list of (model name, parameters), indices of the
+           configurations to group, and whether to group at all
+    Returns: list of lists of configuration indices, each sorted by
+             n_estimators, in grid order of their first member
+    '''
+    groups = {}
+    for i in indices:
+        model_key, parameter = configs[i]
+        if warm_start and 'n_estimators' in parameter and \
+            isinstance(models[model_key], WARM_START_MODELS):
+            key = (model_key, tuple(sorted((name, repr(value))
+                                           for name, value in parameter.items()
+                                           if name != 'n_estimators')))
+        else:
+            key = i
+        groups.setdefault(key, []).append(i)
+
+    return sorted([sorted(group, key=lambda i: configs[i][1]['n_estimators'])
+                   if len(group) > 1 else group for group in groups.values()],
+                  key=min)
+
+
+def run_folds(models, configs, tasks, scorer, n_jobs=1):
+    '''
+    Scores (configuration group, fold) tasks, over a worker pool if
+    n_jobs > 1
+    Takes: dict of models, list of (model name, parameters), list of
+           (group of configuration indices, fold), scorer, and number of
+           worker processes
+    Returns: list of lists of (score, seconds) per group member, in task
+             order
+    '''
+    if n_jobs > 1:
+        print("Starting {} configuration folds on {} workers at {}".format(
+            len(tasks), n_jobs, datetime.datetime.now()))
+        return Parallel(n_jobs=n_jobs)(
+            delayed(score_path)(models[configs[group[0]][0]],
+                                [configs[i][1] for i in group], fold, scorer)
+            for group, fold in tasks)
+
+    fold_results = []
+    started = set()
+    for group, fold in tasks:
+        model_key = configs[group[0]][0]
+        if model_key not in started:
+            started.add(model_key)
+            print("Starting " + model_key + " at " +
+                  str(datetime.datetime.now()))
+        fold_results.append(score_path(models[model_key],
+                                       [configs[i][1] for i in group],
+                                       fold, scorer))
+    return fold_results
+
+
+def mean_auc(fold_scores):
+    '''
+    Mean AUC over the folds a configuration was scored on
+    '''
+    return np.mean([score for score, _ in fold_scores])
+
+
+def successive_halving(models, configs, dataset, scorer, n_jobs=1, eta=None,
+                       seed=None, warm_start=True):
+    '''
+    Cross-validates the configurations fold by fold in rounds. Every round
+    multiplies the number of folds scored by eta and keeps the best 1/eta of
+    the configurations on their mean AUC so far; the rest are dropped
+    without being scored on the remaining folds. With eta None nothing is
+    dropped and every configuration gets all folds (the exhaustive search).
+
+    Input:
+        models (dict): scikit-learn models
+        configs (lst): (model name, parameters) pairs
+        dataset (PreparedDataset): training data and its folds
+        scorer (obj): scikit-learn scorer
+        n_jobs (int): number of worker processes
+        eta (int): halving rate, None for an exhaustive search
+        seed (int): shuffles the folds, see PreparedDataset.splits
+        warm_start (bool): score ensembles that differ only in n_estimators
+                           together, see score_path
+
+    Output:
+        scores (dict): configuration index -> list of (score, seconds) of
+                       the folds it was scored on
+        finalists (lst): indices of the configurations scored on all folds
+    '''
+    scores = {i: [] for i in range(len(configs))}
+    alive = list(range(len(configs)))
+    n_scored = 0
+
+    while n_scored < N_FOLDS:
+        n_next = N_FOLDS if eta is None else min(max(n_scored * eta, 1),
+                                                 N_FOLDS)
+        tasks = [(group, fold)
+                 for group in estimator_paths(models, configs, alive,
+                                              warm_start)
+                 for fold in dataset.folds(is_classifier(models[configs[group[0]][0]]),
+                                           seed)[n_scored:n_next]]
+        for (group, _), results in zip(tasks, run_folds(models, configs, tasks,
+                                                        scorer, n_jobs)):
+            for i, result in zip(group, results):
+                scores[i].append(result)
+        n_scored = n_next
+
+        if n_scored < N_FOLDS:
+            # failed fits (nan) rank last, ties go to grid order
+            ranked = sorted(alive, key=lambda i: (-np.nan_to_num(
+                mean_auc(scores[i]), nan=-np.inf), i))
+            keep = int(np.ceil(len(alive) / eta))
+            alive = sorted(ranked[:keep])
+
+    return scores, alive
+
+
+def check_eta(eta):
+    '''
+    Rejects halving rates below 2: with eta 1 the number of folds never
+    grows and the search does not end, and smaller values do not halve
+    Takes: halving rate
+    Returns: the same halving rate
+    '''
+    if not isinstance(eta, (int, np.integer)) or eta < 2:
+        raise ValueError('Halving rate eta must be an integer >= 2, got '
+                         '{!r}'.format(eta))
+    return eta
+
+
+def eta_arg(value):
+    '''
+    argparse type for -eta, see check_eta
+    '''
+    try:
+        return check_eta(int(value))
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def pick_winner(configs, scores, finalists):
+    '''
+    Best finalist by mean AUC; the first one in grid order wins a tie
+    Returns: index of the winning configuration, None if none beat 0
+    '''
+    max_auc = 0
+    best = None
+    for i in finalists:
+        auc = mean_auc(scores[i])
+        if (auc > max_auc):
+            max_auc = auc
+            best = i
+    return best
+
+
+def report_savings(scores):
+    '''
+    Prints how many fold fits, and roughly how much time, a halving search
+    saved against scoring every configuration on every fold. Time for the
+    folds a configuration skipped is estimated from the folds it was scored
+    on.
+    '''
+    n_fits = sum(len(fold_scores) for fold_scores in scores.values())
+    n_total = N_FOLDS * len(scores)
+    spent = sum(seconds for fold_scores in scores.values()
+                for _, seconds in fold_scores)
+    estimated = sum(N_FOLDS * np.mean([seconds for _, seconds in fold_scores])
+                    for fold_scores in scores.values())
+    print('Fold fits: {} of {} ({:.0%} saved)'.format(
+        n_fits, n_total, 1 - n_fits / n_total))
+    print('Search time: {:.1f}s of an estimated {:.1f}s exhaustive '
+          '({:.0%} saved)'.format(spent, estimated, 1 - spent / estimated))
+
+
+def grid_configs(models, parameters_grid):
+    '''
+    Returns: list of (model name, parameters) over every model's grid
+    '''
+    return [(model_key, parameter) for model_key in models
+            for parameter in ParameterGrid(parameters_grid[model_key])]
 
 
 @ignore_warnings(category=ConvergenceWarning)
 @ignore_warnings(category=FutureWarning)
-def find_best_model(models, parameters_grid, x_train, outcome_label):
+def find_best_model(models, parameters_grid, dataset, n_jobs=1,
+                    search='grid', eta=3, warm_start=True):
     '''
     Cross-validation to find the best model, given parameters.
 
+    Every (model, parameters, fold) combination is an independent task; with
+    n_jobs > 1 they are spread over a worker pool. Results are collected in
+    grid order, so results_df and the winner do not depend on n_jobs.
+
     Input:
         models (dict): dictionary initializing each scikit-learn model
         parameters_grid (dict): dictionary setting hyperparameter values
-        x_train (df): processed training feature dataframe
-        outcome_label (str): name of outcome label
+        dataset (PreparedDataset): prepared training features and labels
+        n_jobs (int): number of worker processes for the search
+        search (str): 'grid' scores every configuration on every fold,
+                      'halving' drops the weakest as folds are added (see
+                      successive_halving)
+        eta (int): halving rate for search='halving'
+        warm_start (bool): grow Bagging and boosting ensembles through their
+                           n_estimators grid instead of refitting each size
 
     Output:
         best_model (obj): best model fit on full training data
@@ -53,39 +357,30 @@ def find_best_model(models, parameters_grid, x_train, outcome_label):
     results_df =  pd.DataFrame(columns=('model_name',
                                         'parameters',
                                         'auc',
+                                        'folds',
                                         'time_to_run'))
-    max_auc = 0
-    best_model = ""
-    best_parameter = ""
     start_time = timeit.default_timer()
-
-    for model_key in models:
-        print("Starting " + model_key + " at " + str(datetime.datetime.now()))
-        model = models[model_key]
-        parameter_values = parameters_grid[model_key]
-        
-        for parameter in ParameterGrid(parameter_values):
-            s = timeit.default_timer()
-            model.set_params(**parameter)
-
-            # Calculate AUC using 5-fold cross validation
-            x_train_no_id = x_train.drop('id', axis=1)
-            x_train_no_id_outcome = x_train_no_id.drop(outcome_label, axis=1)
-            scores = cross_val_score(estimator=model,
-                                     X=x_train_no_id_outcome,
-                                     y=x_train[outcome_label],
-                                     cv=5,
-                                     scoring='roc_auc')
-            auc = scores.mean()
-            time = timeit.default_timer() - start_time
-            results_df.loc[len(results_df)] = [model_key, parameter, auc, time]
-
-            # Update "winner"
-            if (auc > max_auc):
-                max_auc = auc
-                best_model = model
-                best_parameter = parameter
-                best_model_type = model_key
+    if search == 'halving':
+        check_eta(eta)
+
+    scorer = get_scorer('roc_auc')
+    configs = grid_configs(models, parameters_grid)
+    scores, finalists = successive_halving(models, configs, dataset, scorer,
+                                           n_jobs,
+                                           eta if search == 'halving' else None,
+                                           warm_start=warm_start)
+
+    for i, (model_key, parameter) in enumerate(configs):
+        # auc over the folds scored, time spent on them
+        auc = mean_auc(scores[i])
+        time = sum(seconds for _, seconds in scores[i])
+        results_df.loc[len(results_df)] = [model_key, parameter, auc,
+                                           len(scores[i]), time]
+
+    best = pick_winner(configs, scores, finalists)
+    best_model_type, best_parameter = configs[best]
+    best_model = models[best_model_type]
+    max_auc = mean_auc(scores[best])
 
     elapsed = timeit.default_timer() - start_time
 
@@ -94,15 +389,64 @@ def find_best_model(models, parameters_grid, x_train, outcome_label):
     print("Best Model " + str(best_model))
     print("Best Parameter " + str(best_parameter))
     print('Total Time: ', elapsed)
+    if search == 'halving':
+        report_savings(scores)
     
     # Fit best model & best parameters on full training dataset
     best_model.set_params(**best_parameter)
-    best_model.fit(x_train_no_id_outcome,
-                   x_train[outcome_label])
+    best_model.fit(dataset.matrix(), dataset.y)
 
     return best_model
 
 
+@ignore_warnings(category=ConvergenceWarning)
+@ignore_warnings(category=FutureWarning)
+def compare_searches(models, parameters_grid, dataset, n_repeats=5, n_jobs=1,
+                     eta=3):
+    '''
+    Runs the exhaustive and the halving search on n_repeats shuffled fold
+    assignments and prints how often their winners differ and how many fold
+    fits halving saved
+
+    Input:
+        models (dict): dictionary initializing each scikit-learn model
+        parameters_grid (dict): dictionary setting hyperparameter values
+        dataset (PreparedDataset): prepared training features and labels
+        n_repeats (int): number of fold assignments to compare on
+        n_jobs (int): number of worker processes for the search
+        eta (int): halving rate
+
+    Output:
+        comparison (df): winners and fold fits of both searches per repeat
+    '''
+    check_eta(eta)
+    scorer = get_scorer('roc_auc')
+    configs = grid_configs(models, parameters_grid)
+
+    rows = []
+    for seed in range(n_repeats):
+        row = {'seed': seed}
+        for search, rate in (('grid', None), ('halving', eta)):
+            scores, finalists = successive_halving(models, configs, dataset,
+                                                   scorer, n_jobs, rate, seed)
+            best = pick_winner(configs, scores, finalists)
+            row[search + '_winner'] = '{} {}'.format(*configs[best])
+            row[search + '_auc'] = mean_auc(scores[best])
+            row[search + '_fits'] = sum(len(fold_scores)
+                                        for fold_scores in scores.values())
+        rows.append(row)
+    comparison = pd.DataFrame(rows)
+
+    differs = (comparison['grid_winner'] != comparison['halving_winner']).sum()
+    print(comparison)
+    print('Halving winner differs from exhaustive in {} of {} fold '
+          'assignments'.format(differs, n_repeats))
+    print('Fold fits saved: {:.0%}'.format(
+        1 - comparison['halving_fits'].sum() / comparison['grid_fits'].sum()))
+
+    return comparison
+
+
 def plot_precision_recall(y_test, y_hat, model, output_type='save'):
     '''
     Plot precision-recall curve for the test set.
@@ -243,15 +587,19 @@ def main(args):
     Return:
         train (df): pre-processed training dataframe [CHANGE LATER]
     '''
-    models = {'Tree': DecisionTreeRegressor(max_depth=10),
+    # randomized models are seeded so that a parallel search picks the same
+    # winner as a serial one
+    models = {'Tree': DecisionTreeRegressor(max_depth=10, random_state=0),
               'Logistic': LogisticRegression(penalty='l1'),
               'Lasso': Lasso(alpha=0.1),
               'Ridge': Ridge(alpha=.5),
-              'Forest': RandomForestRegressor(max_depth=2),
+              'Forest': RandomForestRegressor(max_depth=2, random_state=0),
             #   'SVM': SVC(C=1, kernel='rbf'),
-              'Bagging': BaggingClassifier(KNeighborsClassifier(), n_estimators=10),
-              'AdaBoost': AdaBoostClassifier(n_estimators=50),
-              'GradientBoost': GradientBoostingClassifier(learning_rate=0.05),
+              'Bagging': BaggingClassifier(KNeighborsClassifier(), n_estimators=10,
+                                           random_state=0),
+              'AdaBoost': AdaBoostClassifier(n_estimators=50, random_state=0),
+              'GradientBoost': GradientBoostingClassifier(learning_rate=0.05,
+                                                          random_state=0),
               }
 
     parameters_grid = {'Tree': {'max_depth': [10, 20, 50]},
@@ -269,27 +617,53 @@ def main(args):
                        }
 
     outcome = 'pathology'
+    features = args.features.split(',') if args.features else None
 
     if args.train and args.train_csv:
         print("Beginning feature generation...")
         t0 = timeit.default_timer()
-        train, test = pipe.go(args.train, args.train_csv, args.test, args.test_csv)
+        train, test = pipe.go(args.train, args.train_csv, args.test, args.test_csv,
+                              n_jobs=args.n_jobs, chunksize=args.chunksize,
+                              cache_dir=args.cache_dir,
+                              cache_size=args.cache_mb * 1024 ** 2,
+                              mask_dir=args.mask_dir,
+                              manifest_path=args.manifest,
+                              pixel_dir=args.pixel_dir,
+                              features=features,
+                              store_dir=args.store_dir,
+                              timeout=args.timeout or None,
+                              stage_timeouts=pipe.parse_stage_timeouts(args.stage_timeouts))
         train.to_csv("current_train.csv")
         test.to_csv("current_test.csv")
         t1 = timeit.default_timer() - t0
         print("Feature generation complete, runtime: ", t1)
     else:
         print("Loading features from csv...")
-        train = pd.read_csv("current_train.csv")
-        test = pd.read_csv("current_test.csv")
-
-    best_model = find_best_model(models, parameters_grid, train, outcome)
+        # the saved index is not a feature
+        train = pd.read_csv("current_train.csv", index_col=0)
+        test = pd.read_csv("current_test.csv", index_col=0)
+
+    # features, labels and folds converted once for the search, the refit
+    # and test scoring
+    dataset = PreparedDataset(train, outcome, scale=args.scale,
+                              n_folds=N_FOLDS)
+
+    if args.compare_search:
+        compare_searches(models, parameters_grid, dataset,
+                         n_repeats=args.compare_search,
+                         n_jobs=args.search_jobs, eta=args.eta)
+
+    best_model = find_best_model(models, parameters_grid, dataset,
+                                 n_jobs=args.search_jobs, search=args.search,
+                                 eta=args.eta)
+    if args.model_out:
+        save_artifact(args.model_out, best_model, dataset, features)
+        print("Model saved to " + args.model_out)
 
     #Run predictions on test data and calculate AUC
     if args.test:
         test.to_csv("current_test.csv")
-        y_hats = best_model.predict(test.drop(columns=['id', 'pathology'],
-                                              axis=1))
+        y_hats = best_model.predict(dataset.transform(test))
         roc_auc = roc_auc_score(test['pathology'], y_hats)
 
         print("Testing Data ROC_AUC Score: ", roc_auc)
@@ -314,6 +688,23 @@ if __name__ == '__main__':
     parser.add_argument("-train_csv", "--train_csv", default = "", help = "Training csv file path")
     parser.add_argument("-test", "--test", default= "", help = "Test image file path")
     parser.add_argument("-test_csv", "--test_csv", default="", help = "Testing csv file path")
+    parser.add_argument("-n_jobs", "--n_jobs", type=int, default=1, help = "Number of featurization worker processes")
+    parser.add_argument("-chunksize", "--chunksize", type=int, default=1, help = "Images handed to a worker at a time")
+    parser.add_argument("-cache_dir", "--cache_dir", default="", help = "Feature cache directory")
+    parser.add_argument("-cache_mb", "--cache_mb", type=int, default=1024, help = "Feature cache size limit in MB")
+    parser.add_argument("-mask_dir", "--mask_dir", default="", help = "Segmentation mask store directory")
+    parser.add_argument("-manifest", "--manifest", default="", help = "Manifest csv file path from manifest.py")
+    parser.add_argument("-pixel_dir", "--pixel_dir", default="", help = "Pixel store directory from pixel_store.py")
+    parser.add_argument("-features", "--features", default="", help = "Comma-separated feature groups to compute, e.g. region,spiculation,circularity (default all)")
+    parser.add_argument("-store_dir", "--store_dir", default="", help = "Incremental feature store directory; only new or changed files are featurized")
+    parser.add_argument("-timeout", "--timeout", type=float, default=0, help = "Seconds one image may take before its worker is killed (default no limit)")
+    parser.add_argument("-stage_timeouts", "--stage_timeouts", default="", help = "Per-stage time budgets in seconds, e.g. segment=120,snake=60")
+    parser.add_argument("-search_jobs", "--search_jobs", type=int, default=1, help = "Number of worker processes for the model search")
+    parser.add_argument("-search", "--search", default="grid", choices=["grid", "halving"], help = "Model search: exhaustive grid or successive halving over folds")
+    parser.add_argument("-eta", "--eta", type=eta_arg, default=3, help = "Halving rate: folds grow and configurations shrink by this factor per round")
+    parser.add_argument("-compare_search", "--compare_search", type=int, default=0, help = "Compare halving against the exhaustive search on this many shuffled fold assignments")
+    parser.add_argument("-scale", "--scale", action="store_true", help = "Standardize features, fitting the scaler within each CV fold")
+    parser.add_argument("-model_out", "--model_out", default="best_model.pkl", help = "Path for the model artifact used by model_artifact.py, empty to skip saving")
 
     args = parser.parse_args()
 
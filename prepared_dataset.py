@@ -0,0 +1,109 @@
+#============================================================================#
+# PREPARED DATASET FOR MODEL SELECTION
+#============================================================================#
+
+'''
+Converts a feature table into the arrays model selection works on, once: a
+contiguous float32 feature matrix in a fixed column order and its label
+vector. Cross-validation folds, and the per-fold standardization if it is
+turned on, are computed the first time they are asked for and then shared by
+every model and parameter setting. The same object refits the winner on the
+full training set and converts the test set with the training column order
+and scaling.
+'''
+
+import numpy as np
+from sklearn.model_selection import check_cv, KFold, StratifiedKFold
+from sklearn.preprocessing import StandardScaler
+
+
+def as_matrix(values):
+    '''
+    Returns: contiguous float32 copy (or view) of a 2D array
+    '''
+    return np.ascontiguousarray(values, dtype=np.float32)
+
+
+class PreparedDataset:
+    '''
+    Feature matrix, labels, and cached CV folds of a feature table.
+
+    Input:
+        df (df): feature dataframe with an id column
+        outcome_label (str): name of the outcome column
+        scale (bool): standardize features, fitting the scaler on the
+                      training rows of each fold and on all rows for the
+                      final model
+        n_folds (int): number of cross-validation folds
+    '''
+
+    def __init__(self, df, outcome_label, scale=False, n_folds=5):
+        self.outcome_label = outcome_label
+        self.columns = [column for column in df.columns
+                        if column not in ('id', outcome_label)]
+        self.ids = df['id'].values
+        self.X = as_matrix(df[self.columns].values)
+        self.y = df[outcome_label].values
+        self.scale = scale
+        self.n_folds = n_folds
+        self.scaler = StandardScaler().fit(self.X) if scale else None
+        self._folds = {}
+
+
+    def matrix(self):
+        '''
+        Returns: training matrix for the final refit, scaled if enabled
+        '''
+        if self.scaler is None:
+            return self.X
+        return as_matrix(self.scaler.transform(self.X))
+
+
+    def transform(self, df):
+        '''
+        Converts another feature table (e.g. the test set) with the training
+        column order and scaling
+        Takes: feature dataframe
+        Returns: float32 feature matrix
+        '''
+        X = as_matrix(df[self.columns].values)
+        if self.scaler is None:
+            return X
+        return as_matrix(self.scaler.transform(X))
+
+
+    def splits(self, classifier, seed=None):
+        '''
+        Fold indices as cross_val_score(cv=n_folds) makes them: stratified
+        for classifiers, plain k-fold otherwise; a seed shuffles the rows
+        first
+        Returns: list of (train, test) index arrays
+        '''
+        if seed is None:
+            cv = check_cv(self.n_folds, self.y, classifier=classifier)
+        elif classifier:
+            cv = StratifiedKFold(self.n_folds, shuffle=True,
+                                 random_state=seed)
+        else:
+            cv = KFold(self.n_folds, shuffle=True, random_state=seed)
+        return list(cv.split(self.X, self.y))
+
+
+    def folds(self, classifier, seed=None):
+        '''
+        Cross-validation folds, computed once per split type
+        Takes: whether the model is a classifier, optional shuffle seed
+        Returns: list of (X_train, y_train, X_test, y_test) per fold
+        '''
+        key = (classifier, seed)
+        if key not in self._folds:
+            folds = []
+            for train, test in self.splits(classifier, seed):
+                X_train, X_test = self.X[train], self.X[test]
+                if self.scale:
+                    scaler = StandardScaler().fit(X_train)
+                    X_train = as_matrix(scaler.transform(X_train))
+                    X_test = as_matrix(scaler.transform(X_test))
+                folds.append((X_train, self.y[train], X_test, self.y[test]))
+            self._folds[key] = folds
+        return self._folds[key]
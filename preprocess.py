@@ -10,67 +10,287 @@ import matplotlib.pyplot as plt
 from skimage import exposure, img_as_float
 from skimage.segmentation import (morphological_chan_vese,
                                   checkerboard_level_set)
+from skimage.segmentation import morphsnakes
 from skimage.filters import threshold_otsu
 from skimage.filters import threshold_mean
 from skimage.morphology import opening
 from skimage.measure import label
+from skimage.measure import block_reduce
 from sklearn.utils.testing import ignore_warnings
 
+from intensity_stats import histogram_of
+
 
 # DELETE THIS LATER 
 from skimage.measure import label, regionprops, regionprops_table
 
 
+# Parameters that determine the segmentation mask. Anything stored per mask
+# (see mask_store.py) is keyed on these, so add new knobs here.
+SEGMENTATION_PARAMS = {'pctile': 50,
+                       'acwe_iterations': 3,
+                       'acwe_smoothing': 1,
+                       'checkerboard_square': 6,
+                       # coarse-to-fine ACWE: downsampling factor (1 = off)
+                       # and full-resolution refinement iterations
+                       'acwe_scale': 1,
+                       'acwe_refine_iterations': 1,
+                       # stop ACWE once fewer than this fraction of pixels
+                       # change in an iteration (0 = run every iteration)
+                       'acwe_tol': 0.0,
+                       # memory-lean mode: boolean masks and a float32 binary
+                       # image instead of int64 masks and float64
+                       'lean': False}
+
 
 @ignore_warnings(category=FutureWarning)
-def threshold_img(img, pctile=50):
+def threshold_img(img, pctile=50, lean=False):
     '''
     Rescales image intensity and thresholds
-    Takes: image pixel array, percentile threshold value
+    Takes: image pixel array, percentile threshold value, and whether to
+           return float32 (lean mode) rather than float64
     Returns: thresholded binary image pixel array
     '''
 
-    # rescaling --> consider exposure.equalize_hist
-    p_thresh, p100 = np.percentile(img, (pctile, 100))
-    img_scaled = exposure.rescale_intensity(img, in_range=(p_thresh, p100))
+    hist = histogram_of(img)
+    if hist is None:
+        # rescaling --> consider exposure.equalize_hist
+        p_thresh, p100 = np.percentile(img, (pctile, 100))
+        img_scaled = exposure.rescale_intensity(img, in_range=(p_thresh, p100))
 
-    # thresholding
-    # img_thresh = threshold_otsu(img_scaled)
-    img_thresh = threshold_mean(img_scaled)
+        # thresholding
+        # img_thresh = threshold_otsu(img_scaled)
+        img_thresh = threshold_mean(img_scaled)
 
-    # Figure out what background is, make sure it's 0
-    original = img_scaled > img_thresh
+        # Figure out what background is, make sure it's 0
+        original = img_scaled > img_thresh
+    else:
+        # same steps on the histogram: rescale and threshold every intensity
+        # level once, then look each pixel up
+        p_thresh, p100 = hist.percentile((pctile, 100))
+        levels_scaled = exposure.rescale_intensity(hist.levels,
+                                                   in_range=(p_thresh, p100))
+        img_thresh = hist.mean(levels_scaled)
+        original = (levels_scaled > img_thresh)[img]
+    if lean:
+        # 0/1 are exact in float32, at half the size
+        return original.astype(np.float32)
     original = img_as_float(original)
 
     return original
 
 
-def store_evolution_in(lst):
+def reset_curvature_operator():
     '''
-    Returns a callback function to store the evolution of the level sets in
-    the given list.
+    morphological_chan_vese alternates between two curvature operators via a
+    module-level cycle that carries over from one call to the next, so an
+    image's mask would depend on how many images the same process segmented
+    before it. Restarting the cycle makes every image segment the same way
+    whatever order, or worker process, it is handled in.
     '''
+    morphsnakes._curvop = morphsnakes._fcycle(
+        [lambda u: morphsnakes.sup_inf(morphsnakes.inf_sup(u)),  # SIoIS
+         lambda u: morphsnakes.inf_sup(morphsnakes.sup_inf(u))]) # ISoSI
 
-    def _store(x):
-        lst.append(np.copy(x))
 
-    return _store
+def lean_chan_vese(image, iterations, init_level_set, smoothing=1,
+                   iter_callback=lambda x: None):
+    '''
+    Memory-lean morphological_chan_vese (lambda1 = lambda2 = 1). Instead of
+    the float64 gradient and attachment arrays it keeps boolean edge and
+    side masks and two float32 distance buffers, all allocated once; the
+    curvature smoothing is skimage's own, so the operator cycle is shared.
+    On 0/1 images (threshold_img) the level sets equal the float64 ones; on
+    other float32 images a pixel can only flip where its distances to the
+    two region means tie within float32 rounding.
+    Takes: float32 image, iterations, initial level set, smoothing steps and
+           callback, as for morphological_chan_vese
+    Returns: int8 level set
+    '''
+    u = np.int8(init_level_set > 0)
+    edge = np.empty(u.shape, dtype=bool)
+    side = np.empty(u.shape, dtype=bool)
+    to_c1 = np.empty(u.shape, dtype=np.float32)
+    to_c0 = np.empty(u.shape, dtype=np.float32)
+    total = image.sum(dtype=np.float64)
+
+    iter_callback(u)
+
+    for _ in range(iterations):
+
+        # region means, as (image * u).sum() / float(u.sum() + 1e-8)
+        n1 = np.count_nonzero(u)
+        s1 = np.sum(image, where=u.view(bool), dtype=np.float64)
+        c0 = (total - s1) / float(u.size - n1 + 1e-8)
+        c1 = s1 / float(n1 + 1e-8)
+
+        # pixels where np.gradient(u) is non-zero along either axis
+        for axis in (0, 1):
+            a = np.moveaxis(u, axis, 0)
+            e = np.moveaxis(side, axis, 0)
+            np.not_equal(a[2:], a[:-2], out=e[1:-1])
+            np.not_equal(a[1], a[0], out=e[0])
+            np.not_equal(a[-1], a[-2], out=e[-1])
+            if axis == 0:
+                np.copyto(edge, side)
+            else:
+                np.logical_or(edge, side, out=edge)
+
+        # image attachment: edge pixels join the nearer region mean
+        np.abs(np.subtract(image, c1, out=to_c1), out=to_c1)
+        np.abs(np.subtract(image, c0, out=to_c0), out=to_c0)
+        np.putmask(u, np.logical_and(edge, np.less(to_c1, to_c0, out=side),
+                                     out=side), 1)
+        np.putmask(u, np.logical_and(edge, np.greater(to_c1, to_c0, out=side),
+                                     out=side), 0)
+
+        # Smoothing
+        for _ in range(smoothing):
+            u = morphsnakes._curvop(u)
+
+        iter_callback(u)
+
+    return u
+
+
+def lean_checkerboard(shape, square_size):
+    '''
+    checkerboard_level_set built from one row and one column of parity
+    instead of a full int64 coordinate grid per axis
+    Takes: image shape and square size
+    Returns: int8 level set, equal to checkerboard_level_set(shape, square_size)
+    '''
+    rows = (np.arange(shape[0]) // square_size & 1).astype(np.int8)
+    cols = (np.arange(shape[1]) // square_size & 1).astype(np.int8)
+
+    return np.bitwise_xor(rows[:, None], cols[None, :])
 
 
-def apply_ACWE(img):
+class ACWEConverged(Exception):
     '''
-    Segments largest region using ACWE.
+    Raised from the iteration callback to stop morphological_chan_vese once
+    the level set has settled
     '''
-    init_ls = checkerboard_level_set(img.shape, 6)
-    evolution = []
-    callback = store_evolution_in(evolution)
-    l = morphological_chan_vese(img, 3, init_level_set=init_ls,
-                                smoothing=1,
-                                iter_callback=callback)
-    
-    #plt.figure(figsize=(9, 3))
-    #plt.imshow(ls, cmap="gray")
-    #plt.contour(evolution[3], [0.5], colors='y')
+
+
+def run_ACWE(img, iterations, init_level_set, smoothing, tol=0.0,
+             debug=False, lean=False):
+    '''
+    Runs morphological_chan_vese for at most the given number of iterations,
+    stopping early once the fraction of pixels that changed in an iteration
+    drops below tol. Only two buffers the size of the image are allocated up
+    front; the level set history is kept only in debug mode. Lean mode runs
+    lean_chan_vese instead.
+    Takes: image, maximum iterations, initial level set, smoothing steps,
+           convergence tolerance, debug flag and lean flag
+    Returns: level set, number of iterations used, and list of the initial
+             level set followed by the one after each iteration (None unless
+             debug)
+    '''
+    previous = np.array(np.asarray(init_level_set) > 0, dtype=np.int8)
+    changed = np.empty(previous.shape, dtype=bool)
+    history = [] if debug else None
+    # the callback also sees the initial level set, before any iteration
+    used = [-1]
+
+    def _step(u):
+        used[0] += 1
+        if history is not None:
+            history.append(np.copy(u))
+        if used[0] == 0:
+            return
+        np.not_equal(previous, u, out=changed)
+        fraction = np.count_nonzero(changed) / changed.size
+        np.copyto(previous, u)
+        if fraction < tol:
+            raise ACWEConverged()
+
+    evolve = lean_chan_vese if lean else morphological_chan_vese
+    reset_curvature_operator()
+    try:
+        ls = evolve(img, iterations, init_level_set=init_level_set,
+                    smoothing=smoothing, iter_callback=_step)
+    except ACWEConverged:
+        # previous holds the level set of the last iteration
+        ls = previous
+
+    return ls, used[0], history
+
+
+def count_iterations(stats, used, history=None):
+    '''
+    Adds ACWE iterations to an optional stats dict, and stores the level set
+    history of a debug run in stats['acwe_history']
+    '''
+    if stats is not None:
+        stats['acwe_iterations'] = stats.get('acwe_iterations', 0) + used
+        if history is not None:
+            stats['acwe_history'] = history
+
+
+def apply_ACWE_pyramid(img, scale, iterations, refine_iterations, smoothing,
+                       square_size, tol=0.0, stats=None, lean=False,
+                       debug=False):
+    '''
+    Coarse-to-fine ACWE: segments a block-averaged copy of the image that is
+    scale times smaller, upsamples the level set and refines it with a few
+    iterations at full resolution. The two levels are counted separately:
+    stats['acwe_iterations'] (and 'acwe_history' in debug mode) describe the
+    full resolution refinement, 'acwe_coarse_iterations' (and
+    'acwe_coarse_history') the coarse level.
+    '''
+    coarse = block_reduce(img, (scale, scale), np.mean)
+    if lean:
+        coarse = coarse.astype(np.float32, copy=False)
+    coarse_stats = {} if stats is not None else None
+    # scale=1 explicitly: the default is bound from SEGMENTATION_PARAMS and
+    # would send the coarse level back into the pyramid
+    coarse_ls = apply_ACWE(coarse, iterations, smoothing, square_size, scale=1,
+                           tol=tol, stats=coarse_stats, lean=lean, debug=debug)
+    if stats is not None:
+        stats['acwe_coarse_iterations'] = \
+            stats.get('acwe_coarse_iterations', 0) + \
+            coarse_stats['acwe_iterations']
+        if debug:
+            stats['acwe_coarse_history'] = coarse_stats['acwe_history']
+
+    init_ls = np.repeat(np.repeat(coarse_ls, scale, axis=0), scale, axis=1)
+    init_ls = init_ls[:img.shape[0], :img.shape[1]]
+
+    ls, used, history = run_ACWE(img, refine_iterations, init_ls, smoothing,
+                                 tol, debug, lean)
+    count_iterations(stats, used, history)
+
+    return ls
+
+
+def apply_ACWE(img, iterations=SEGMENTATION_PARAMS['acwe_iterations'],
+               smoothing=SEGMENTATION_PARAMS['acwe_smoothing'],
+               square_size=SEGMENTATION_PARAMS['checkerboard_square'],
+               scale=SEGMENTATION_PARAMS['acwe_scale'],
+               refine_iterations=SEGMENTATION_PARAMS['acwe_refine_iterations'],
+               tol=SEGMENTATION_PARAMS['acwe_tol'], stats=None,
+               lean=SEGMENTATION_PARAMS['lean'], debug=False):
+    '''
+    Segments largest region using ACWE. With scale > 1 the segmentation runs
+    coarse-to-fine, see apply_ACWE_pyramid. Iterations stop early once less
+    than a tol fraction of pixels change, see run_ACWE.
+    If a stats dict is given, the number of iterations used is added to
+    stats['acwe_iterations'], and in debug mode the level set history is
+    stored in stats['acwe_history']. Lean mode expects a float32 image.
+    '''
+    if scale > 1:
+        return apply_ACWE_pyramid(img, scale, iterations, refine_iterations,
+                                  smoothing, square_size, tol, stats, lean,
+                                  debug)
+
+    if lean:
+        init_ls = lean_checkerboard(img.shape, square_size)
+    else:
+        init_ls = checkerboard_level_set(img.shape, square_size)
+    l, used, history = run_ACWE(img, iterations, init_ls, smoothing, tol,
+                                debug, lean)
+    count_iterations(stats, used, history)
 
     return l
 
@@ -98,13 +318,20 @@ def check_segmentation(binary, segment):
 
 
 # label image regions
-def define_region(img):
+def define_region(img, lean=False):
     '''
-    Keeps the largest region only.
+    Keeps the largest region only, as a boolean mask in lean mode and a 0/1
+    integer mask otherwise.
     '''
     # Figure out what the background is
     # Whatever the majority of the four corners is = background
     labels = label(img)
+    if lean:
+        # img is 0/1, so weighting by it only zeroes the background count;
+        # doing that directly avoids a float64 copy of the weights
+        sizes = np.bincount(labels.ravel())
+        sizes[0] = 0
+        return labels == np.argmax(sizes)
     largestCC = labels == np.argmax(np.bincount(labels.flat,
                                                 weights=img.flat))
     main = (1 * largestCC)
@@ -112,25 +339,88 @@ def define_region(img):
     return main
 
 
-def fill_holes(img):
+def fill_holes(img, lean=False):
     '''
-    Fills all holes.
+    Fills all holes. Returns a boolean mask in lean mode.
     '''
     filled = scipy.ndimage.morphology.binary_fill_holes(img)
+    if lean:
+        return filled
 
     return (1 * filled)
 
 
-def go(file):
+def segment_pixels(img, params=SEGMENTATION_PARAMS, stats=None, debug=False):
     '''
-    Run all functions.
+    Run all segmentation functions on a pixel array.
+    Takes: image pixel array, dict of segmentation parameters, optional
+           dict that receives the number of ACWE iterations used, and debug
+           flag to also keep the ACWE level set history (see apply_ACWE)
+    Returns: filled region mask
     '''
-    original = pydicom.dcmread(file, force=True)
-    binary = threshold_img(original.pixel_array, pctile=50)
-    segment = apply_ACWE(binary)
+    lean = params['lean']
+    binary = threshold_img(img, pctile=params['pctile'], lean=lean)
+    segment = apply_ACWE(binary, params['acwe_iterations'],
+                         params['acwe_smoothing'],
+                         params['checkerboard_square'], params['acwe_scale'],
+                         params['acwe_refine_iterations'],
+                         params['acwe_tol'], stats, lean, debug)
     confirmed_filled = check_segmentation(binary, segment)
-    main_region = define_region(confirmed_filled)
-    filled = fill_holes(main_region)
+    main_region = define_region(confirmed_filled, lean)
+    filled = fill_holes(main_region, lean)
+
+    return filled
+
+
+def segment(original, masks=None, stats=None, params=None, debug=False):
+    '''
+    Run all segmentation functions on an image that has already been read.
+    Takes: pydicom dataset, optional MaskStore of previously computed masks,
+           optional stats dict (see segment_pixels; left untouched when the
+           mask comes from the store), segmentation parameters (None for
+           SEGMENTATION_PARAMS) and debug flag (see segment_pixels; a debug
+           run always segments, so that the history is recorded)
+    Returns: filled region mask
+    '''
+    if params is None:
+        params = SEGMENTATION_PARAMS
+
+    if masks is not None:
+        key = masks.key(original, params)
+        filled = None if debug else masks.load(key, params['lean'])
+        if filled is not None:
+            return filled
+
+    filled = segment_pixels(original.pixel_array, params, stats, debug)
+
+    if masks is not None:
+        masks.save(key, filled)
+
+    return filled
+
+
+def read_image(file, pixels=None):
+    '''
+    Reads an image, preferring a zero-copy view from a PixelStore
+    Takes: DICOM file path and optional PixelStore
+    Returns: pydicom dataset, or ImageView if the file is in the store
+    '''
+    if pixels is not None:
+        original = pixels.lookup(file)
+        if original is not None:
+            return original
+
+    return pydicom.dcmread(file, force=True)
+
+
+def go(file, masks=None, pixels=None):
+    '''
+    Run all functions.
+    Takes: DICOM file path, optional MaskStore to load/save the mask, and
+           optional PixelStore to read pixels from
+    '''
+    original = read_image(file, pixels)
+    filled = segment(original, masks)
     
     return filled, original
 
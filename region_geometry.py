@@ -0,0 +1,83 @@
+#============================================================================#
+# REGION GEOMETRY
+#============================================================================#
+
+'''
+Everything derived from the connected regions of a segmentation mask. The
+mask is labeled and measured with regionprops once per image, and the region
+property columns and circularity are both read from that single pass.
+'''
+
+import numpy as np
+from skimage.measure import label, regionprops
+
+
+class RegionGeometry:
+    '''
+    Labels a region mask once and keeps its regionprops.
+
+    Input:
+        mask (numpy array): filled region mask, 0/1 or boolean
+    '''
+
+    def __init__(self, mask):
+        self.mask = mask
+        self.label_image = label(mask)
+        self.regions = regionprops(self.label_image)
+
+
+    @property
+    def region(self):
+        '''
+        The first labeled region, the only one for masks from p.segment
+        '''
+        return self.regions[0]
+
+
+    def table(self, properties):
+        '''
+        Region properties of the first region, as
+        regionprops_table(label_image, properties) gives them
+        Takes: list of property names
+        Returns: dict of property name to value
+        '''
+        return {prop: self.region[prop] for prop in properties}
+
+
+    def circle_window(self, center, radius):
+        '''
+        Bounding box of a circle clipped to the mask, so that pixels within
+        radius of center can be counted without a full-image distance map
+        Takes: (row, column) center and radius
+        Returns: tuple of row and column index arrays, shaped for broadcasting
+        '''
+        h, w = self.mask.shape
+        y0, x0 = center
+        rows = np.arange(max(int(np.floor(y0 - radius)), 0),
+                         min(int(np.ceil(y0 + radius)) + 1, h))
+        cols = np.arange(max(int(np.floor(x0 - radius)), 0),
+                         min(int(np.ceil(x0 + radius)) + 1, w))
+
+        return rows[:, None], cols[None, :]
+
+
+    def circularity(self):
+        '''
+        Fraction of the circle with the region's area, centered on its
+        centroid, that the region covers. Equal to
+        create_features.compute_circularity via circular_mask, counted in the
+        circle's bounding box only.
+        Returns: circularity
+        '''
+        y0, x0 = self.region.centroid
+        # circular_mask truncates the radius to whole pixels
+        radius = int(np.sqrt(self.region.area / np.pi))
+
+        y, x = self.circle_window((y0, x0), radius)
+        inside = np.sqrt((x - x0) ** 2 + (y - y0) ** 2) <= radius
+        window = self.mask[y, x]
+
+        overlap = np.count_nonzero(inside & (window == 1))
+        rest_of_circle = np.count_nonzero(inside & (window == 0))
+
+        return overlap / (overlap + rest_of_circle)
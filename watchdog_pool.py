@@ -0,0 +1,188 @@
+#============================================================================#
+# SUPERVISED WORKER POOL WITH TIME BUDGETS
+#============================================================================#
+
+'''
+Worker processes that report which stage of a task they are in, watched by
+the parent against a per-task and per-stage time budget. A worker that
+overruns either budget is killed and replaced, the task is reported as timed
+out together with the stage it was stuck in, and the remaining tasks carry
+on. A worker that dies on its own (e.g. killed for running out of memory) is
+replaced the same way.
+
+Each worker talks to the parent over its own pipe, so killing one never
+leaves a shared queue half written.
+'''
+
+import time
+import multiprocessing as mp
+from collections import deque
+from multiprocessing.connection import wait
+
+# stage reported before the task function names one
+START_STAGE = 'start'
+
+
+def work(function, conn):
+    '''
+    Worker loop: runs function(task, progress=progress) for each task until
+    it gets None. progress(stage) tells the parent which stage is running.
+    '''
+    def progress(stage):
+        conn.send(('stage', stage))
+
+    while True:
+        task = conn.recv()
+        if task is None:
+            return
+        conn.send(('done', function(task, progress=progress)))
+
+
+class Worker:
+    '''
+    One worker process, its pipe, and the task it is running.
+    '''
+
+    def __init__(self, function):
+        self.conn, child_conn = mp.Pipe()
+        self.process = mp.Process(target=work, args=(function, child_conn),
+                                  daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.index = None
+
+
+    def assign(self, index, task):
+        now = time.monotonic()
+        self.index = index
+        self.stage = START_STAGE
+        self.started = now
+        self.stage_started = now
+        self.conn.send(task)
+
+
+    def enter(self, stage):
+        self.stage = stage
+        self.stage_started = time.monotonic()
+
+
+    def deadline(self, timeout, stage_timeouts):
+        '''
+        Time at which the running task overruns its budget, None if neither
+        budget applies
+        '''
+        deadlines = []
+        if timeout is not None:
+            deadlines.append(self.started + timeout)
+        if stage_timeouts.get(self.stage) is not None:
+            deadlines.append(self.stage_started + stage_timeouts[self.stage])
+        return min(deadlines) if deadlines else None
+
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+
+class Watchdog:
+    '''
+    Pool of supervised worker processes.
+
+    Input:
+        function: called as function(task, progress=progress) in a worker;
+                  progress takes a stage name. Must be picklable if
+                  processes are spawned rather than forked.
+        n_workers (int): number of worker processes
+        timeout (float): seconds one task may take, None for no limit
+        stage_timeouts (dict): stage name -> seconds that stage may take
+    '''
+
+    def __init__(self, function, n_workers=1, timeout=None,
+                 stage_timeouts=None):
+        self.function = function
+        self.n_workers = max(n_workers, 1)
+        self.timeout = timeout
+        self.stage_timeouts = stage_timeouts or {}
+
+
+    def imap(self, tasks, window=None):
+        '''
+        Runs the tasks, at most window of them submitted but not yet
+        yielded (two per worker by default)
+        Takes: list of tasks
+        Returns: generator of (result, failure) in task order; failure is
+                 None on success, otherwise result is None and failure is
+                 ('timeout', stage) or ('died', stage)
+        '''
+        window = max(window or 2 * self.n_workers, 1)
+        workers = [Worker(self.function) for _ in range(self.n_workers)]
+        queued = deque(enumerate(tasks))
+        finished = {}
+        next_index = 0
+
+        try:
+            while next_index < len(tasks):
+                # hand out tasks while the window has room
+                for worker in workers:
+                    if worker.index is None and queued and \
+                        queued[0][0] < next_index + window:
+                        worker.assign(*queued.popleft())
+
+                busy = [worker for worker in workers if worker.index is not None]
+                deadlines = [worker.deadline(self.timeout, self.stage_timeouts)
+                             for worker in busy]
+                deadlines = [d for d in deadlines if d is not None]
+                wait_for = max(min(deadlines) - time.monotonic(), 0) \
+                    if deadlines else None
+
+                ready = wait([worker.conn for worker in busy], wait_for)
+                for i, worker in enumerate(workers):
+                    if worker.index is None:
+                        continue
+
+                    if worker.conn in ready:
+                        try:
+                            kind, value = worker.conn.recv()
+                        except (EOFError, OSError):
+                            finished[worker.index] = (None,
+                                                      ('died', worker.stage))
+                            worker.kill()
+                            workers[i] = Worker(self.function)
+                            continue
+                        if kind == 'stage':
+                            worker.enter(value)
+                        else:
+                            finished[worker.index] = (value, None)
+                            worker.index = None
+                        continue
+
+                    deadline = worker.deadline(self.timeout,
+                                               self.stage_timeouts)
+                    if deadline is not None and time.monotonic() >= deadline:
+                        finished[worker.index] = (None,
+                                                  ('timeout', worker.stage))
+                        worker.kill()
+                        workers[i] = Worker(self.function)
+
+                while next_index in finished:
+                    yield finished.pop(next_index)
+                    next_index += 1
+        finally:
+            for worker in workers:
+                if worker.index is None:
+                    worker.stop()
+                else:
+                    worker.kill()